@@ -0,0 +1,340 @@
+# Semi-dense depth maps from the VO poses (Readme: dense depth map generation).
+# The strongest gradient pixel of every 4x4 block of the keyframe (when strong
+# enough) carries a Gaussian filter over its inverse depth (mean, variance),
+# stored as (H,W) arrays. Every new frame with its pose searches each pixel
+# along its epipolar line in the new frame, the segment between the
+# projections of the inverse depths mean -/+ 2 sigma, turns the best match
+# into an inverse depth observation and fuses it into the filter (LSD-SLAM,
+# Engel et al. 2013).
+# The epipolar line of a pixel is the one compute_epipolar_line
+# (epipolar_geo) gives for the fundamental matrix of the two poses, here
+# parametrized by the inverse depth directly.
+# All the pixels of a frame are updated together: the epipolar segments are
+# sampled with one cv2.remap per group of similar segment lengths (converged
+# filters only need a few candidates) and the patch comparison is a sliding
+# window over the samples.
+#
+#   python -m roadmap.adv_vo.depth_filter --video 0.hevc --out depth/
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+from roadmap.adv_vo.direct_vo import select_pixels
+from roadmap.basic_vo.pipeline import VisualOdometry, FRONT_ENDS, INTRINSIC_MATRIX, run_sequence, scale_intrinsic_matrix
+
+# cv2.remap sizes must stay below SHRT_MAX
+_REMAP_WIDTH = 16384
+# patch of 5 samples along the epipolar line, at 1 pixel spacing
+_PATCH = 5
+# intensity of the samples outside of the image, no patch matches there
+OUTSIDE = 1e4
+
+
+def sample_lines(image, origins, directions, steps):
+    # bilinear samples of the float32 image at origins + s directions for the
+    # (2,N) origins and directions and the (S,) steps s, returns (S,N) float32.
+    # Samples outside of the image are OUTSIDE.
+    count = origins.shape[1]
+    # N padded so that the (S,N) maps reshape to rows cv2.remap accepts
+    row = min(max(count, 1), _REMAP_WIDTH)
+    width = -(-max(count, 1) // row) * row
+    steps = np.asarray(steps, np.float32)[:, None]
+    maps = np.full((2, len(steps), width), -1, np.float32)
+    for axis in range(2):
+        np.multiply(steps, directions[axis].astype(np.float32), out=maps[axis, :, :count])
+        maps[axis, :, :count] += origins[axis].astype(np.float32)
+    shape = (-1, row)
+    out = cv2.remap(image, maps[0].reshape(shape), maps[1].reshape(shape), cv2.INTER_LINEAR,
+                    borderMode=cv2.BORDER_CONSTANT, borderValue=OUTSIDE)
+    return out.reshape(len(steps), width)[:, :count]
+
+
+def project(K, points):
+    # (...,3) camera points to (...,2) pixels
+    return (points[..., :2] / points[..., 2:]) * np.diag(K)[:2] + K[:2, 2]
+
+
+class DepthFilter:
+    # Per pixel inverse depth filters of a keyframe.
+    #   cell, min_gradient: semi-dense selection, the pixel with the strongest
+    #     gradient of every cell x cell block gets a filter when its gradient
+    #     is at least min_gradient (cell=1 keeps every strong pixel)
+    #   max_inverse_depth: search range of the pixels without an estimate,
+    #     from infinity (0) to this inverse depth (in the units of the poses)
+    #   search_length: samples of the epipolar segment searched per pixel, a
+    #     longer segment is searched around the projection of the mean
+    #   pixel_noise: standard deviation (pixels) of the match position from
+    #     the pose errors, intensity_noise the one of the image intensities
+    #   max_ssd: mean squared intensity difference of an acceptable match
+    #   max_variance: filters with a larger variance aren't in inverse_depth
+    #   propagation_noise: standard deviation of the inverse depth added to
+    #     the estimates carried over into a new keyframe (pose errors, pixel
+    #     rounding), so they need new observations to stay converged
+    def __init__(self, K, cell=4, min_gradient=8.0, max_inverse_depth=1.0, search_length=24, pixel_noise=0.5,
+                 intensity_noise=4.0, max_ssd=100.0, max_variance=1e-3, min_baseline=1e-3, propagation_noise=1e-3):
+        self.K = np.asarray(K, dtype=np.float64)
+        self.K_inv = np.linalg.inv(self.K)
+        self.cell = cell
+        self.min_gradient = min_gradient
+        self.max_inverse_depth = max_inverse_depth
+        self.search_length = search_length
+        self.pixel_noise = pixel_noise
+        self.intensity_noise = intensity_noise
+        self.max_ssd = max_ssd
+        self.max_variance = max_variance
+        self.min_baseline = min_baseline
+        self.propagation_noise = propagation_noise
+        # variance of a pixel without an estimate, the uniform prior over the range
+        self.initial_variance = max_inverse_depth**2 / 12
+
+        self.keyframe = None
+        self.keyframe_pose = None
+        self.mean = None
+        self.variance = None
+        # flat indices, (3,N) rays x = K^-1 p and (2,N) gradients of the pixels
+        # with a filter, one row per coordinate
+        self.pixels = None
+        self.rays = None
+        self.gradients = None
+        # statistics of the last update
+        self.updated_count = 0
+        self.outlier_count = 0
+
+    def set_keyframe(self, image, pose, propagate=True):
+        # image is the grayscale keyframe and pose its (4,4) camera to world
+        # pose. The estimates of the current keyframe are carried over into the
+        # new one when propagate is True, onto the pixels that get a filter
+        image = np.asarray(image, dtype=np.float32)
+        height, width = image.shape
+        gx = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=1, scale=0.5)
+        gy = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=1, scale=0.5)
+        u, v = select_pixels(gx, gy, self.cell, self.min_gradient, border=_PATCH)
+        self.pixels = v * width + u
+        self.rays = self.K_inv @ np.stack([u, v, np.ones(len(u))])
+        self.gradients = np.stack([gx.ravel()[self.pixels], gy.ravel()[self.pixels]]).astype(np.float64)
+
+        # every pixel without a filter keeps the prior: it is never updated, so
+        # a propagated estimate there would be reported and propagated forever
+        mean = np.zeros((height, width), np.float32)
+        variance = np.full((height, width), self.initial_variance, np.float32)
+        if propagate and self.keyframe is not None:
+            propagated_mean, propagated_variance = mean.copy(), variance.copy()
+            self._propagate(pose, propagated_mean, propagated_variance)
+            mean.ravel()[self.pixels] = propagated_mean.ravel()[self.pixels]
+            variance.ravel()[self.pixels] = propagated_variance.ravel()[self.pixels]
+        self.keyframe, self.keyframe_pose = image, np.asarray(pose, dtype=np.float64)
+        self.mean, self.variance = mean, variance
+
+    def _propagate(self, pose, mean, variance):
+        # moves the converged estimates into the frame of the new keyframe,
+        # the closest point wins when several land on the same pixel
+        known = np.flatnonzero(self.variance.ravel() < self.max_variance)
+        if len(known) == 0:
+            return
+        height, width = mean.shape
+        v, u = np.divmod(known, width)
+        rho = self.mean.ravel()[known].astype(np.float64)
+        relative = np.linalg.inv(pose) @ self.keyframe_pose
+        # X_new = R x / rho + t, scaled by rho to keep points at infinity finite
+        points = np.column_stack([u, v, np.ones(len(u))]) @ self.K_inv.T @ relative[:3, :3].T \
+            + rho[:, None] * relative[:3, 3]
+        in_front = points[:, 2] > 1e-9
+        new_rho = rho[in_front] / points[in_front, 2]
+        pixels = np.rint(project(self.K, points[in_front])).astype(np.int64)
+        inside = (pixels[:, 0] >= 0) & (pixels[:, 0] < width) & (pixels[:, 1] >= 0) & (pixels[:, 1] < height)
+        # d new_rho / d rho = (new_rho / rho)^2 without rotation of the depth,
+        # plus the propagation noise
+        scale = np.where(rho[in_front] > 0, new_rho / np.maximum(rho[in_front], 1e-12), 1.0)**4
+        new_variance = self.variance.ravel()[known][in_front] * scale + self.propagation_noise**2
+        order = np.argsort(new_rho[inside], kind="stable")
+        target = (pixels[inside, 1] * width + pixels[inside, 0])[order]
+        mean.ravel()[target] = new_rho[inside][order]
+        variance.ravel()[target] = new_variance[inside][order]
+
+    @property
+    def inverse_depth(self):
+        # (H,W) inverse depth of the converged pixels, 0 elsewhere
+        return np.where(self.variance < self.max_variance, self.mean, 0).astype(np.float32)
+
+    def update(self, image, pose):
+        # Searches all the keyframe pixels in the new frame (grayscale image,
+        # (4,4) camera to world pose) and fuses the matches into the filters.
+        # returns the number of updated filters
+        self.updated_count = self.outlier_count = 0
+        relative = np.linalg.inv(pose) @ self.keyframe_pose
+        R, t = relative[:3, :3], relative[:3, 3]
+        if np.linalg.norm(t) < self.min_baseline or len(self.pixels) == 0:
+            # no parallax, no depth
+            return 0
+        image = np.asarray(image, dtype=np.float32)
+        K = self.K
+
+        # the ray of a pixel projects to (a + rho b) in homogeneous pixels, all
+        # the per pixel values are (k,N) arrays with one row per coordinate.
+        # Its projection moves along b_xy a_z - a_xy b_z as rho grows
+        a = (K @ R) @ self.rays
+        b = (K @ t)[:, None]
+        direction = b[:2] * a[2] - a[:2] * b[2]
+        direction /= np.maximum(np.hypot(direction[0], direction[1]), 1e-12)
+
+        # the patch direction in the keyframe is along its epipolar line, with
+        # the orientation that maps onto `direction` (infinite homography)
+        epipole = K @ (-R.T @ t)
+        keyframe_direction = (K[:2] @ self.rays) * epipole[2] - epipole[:2, None]
+        keyframe_direction /= np.maximum(np.hypot(keyframe_direction[0], keyframe_direction[1]), 1e-12)
+        moved = a + (K @ R @ self.K_inv)[:, :2] @ keyframe_direction
+        mapped = moved[:2] / moved[2] - a[:2] / a[2]
+        keyframe_direction *= np.where(np.sum(mapped * direction, axis=0) < 0, -1.0, 1.0)
+        # only the gradient along the line makes the match precise
+        gradient = np.abs(np.sum(self.gradients * keyframe_direction, axis=0))
+        index = np.flatnonzero((gradient >= 0.5 * self.min_gradient) & (a[2] > 0))
+
+        # the segment between the projections of mean -/+ 2 sigma, which must
+        # be in front of the camera
+        a, direction = np.take(a, index, axis=1), np.take(direction, index, axis=1)
+        mean = self.mean.ravel()[self.pixels[index]].astype(np.float64)
+        variance = self.variance.ravel()[self.pixels[index]].astype(np.float64)
+        sigma = np.sqrt(variance)
+        rho_near = np.minimum(mean + 2 * sigma, self.max_inverse_depth)
+        rho_far = np.maximum(mean - 2 * sigma, 0.0)
+        near_z, far_z = a[2] + rho_near * b[2], a[2] + rho_far * b[2]
+        far = (a[:2] + rho_far * b[:2]) / np.maximum(far_z, 1e-6)
+        near = (a[:2] + rho_near * b[:2]) / np.maximum(near_z, 1e-6)
+        centre = (a[:2] + mean * b[:2]) / np.maximum(a[2] + mean * b[2], 1e-6)
+        length = np.sum((near - far) * direction, axis=0)
+        valid = np.flatnonzero((near_z > 1e-6) & (far_z > 1e-6) & (length > 1e-3))
+        if len(valid) == 0:
+            return 0
+        index = index[valid]
+        a, direction, far, centre = (np.take(values, valid, axis=1) for values in (a, direction, far, centre))
+        length, mean, variance = length[valid], mean[valid], variance[valid]
+        keyframe_direction, gradient = np.take(keyframe_direction, index, axis=1), gradient[index]
+        pixels = self.pixels[index]
+
+        # the segments are searched in groups of similar length, most of the
+        # filters have converged to a segment of a few pixels
+        half = _PATCH // 2
+        v, u = np.divmod(pixels, self.keyframe.shape[1])
+        reference = sample_lines(self.keyframe, np.stack([u, v]), keyframe_direction, np.arange(-half, half + 1))
+        offset = np.hypot(centre[0] - far[0], centre[1] - far[1])
+        needed = np.ceil(length) + 2 * half + 1
+        s, good = np.zeros(len(index)), np.zeros(len(index), bool)
+        lower = 0
+        for S in [size for size in (8, 16) if size < self.search_length] + [self.search_length]:
+            # the longest segments all take search_length candidates
+            group = np.flatnonzero((needed > lower) & ((needed <= S) | (S == self.search_length)))
+            lower = S
+            if len(group):
+                s[group], good[group] = self._match(image, *(np.take(values, group, axis=1)
+                                                             for values in (reference, far, direction)),
+                                                    length[group], offset[group], S)
+
+        rho = self._inverse_depth_at(a, b, far, direction, s)
+        # d rho / d s over one pixel, for the observation variance
+        slope = np.abs(self._inverse_depth_at(a, b, far, direction, s + 0.5)
+                       - self._inverse_depth_at(a, b, far, direction, s - 0.5))
+        pixel_variance = self.pixel_noise**2 + 2 * self.intensity_noise**2 / np.maximum(gradient, 1e-6)**2
+        observed_variance = slope**2 * pixel_variance
+        good &= np.isfinite(rho) & np.isfinite(observed_variance) & (rho >= 0) & (observed_variance > 0)
+
+        # Gaussian fusion, the first observation replaces the prior and
+        # observations 3 sigma away from the estimate are outliers
+        new = variance >= self.initial_variance
+        consistent = (rho - mean)**2 <= 9 * (variance + observed_variance)
+        self.outlier_count = int(np.count_nonzero(good & ~new & ~consistent))
+        good &= new | consistent
+        fused_variance = np.where(new, observed_variance, variance * observed_variance / (variance + observed_variance))
+        fused_mean = np.where(new, rho, (observed_variance * mean + variance * rho) / (variance + observed_variance))
+        self.mean.ravel()[pixels[good]] = fused_mean[good]
+        self.variance.ravel()[pixels[good]] = fused_variance[good]
+        self.updated_count = int(np.count_nonzero(good))
+        return self.updated_count
+
+    def _match(self, image, reference, far, direction, length, offset, S):
+        # Best match of the (_PATCH,N) keyframe patches among S candidates at
+        # 1 pixel steps along the segments, from `far` by `length` pixels in
+        # `direction`. The whole segment is searched when it's short, with a
+        # margin of half a patch, otherwise the part around `offset`, the
+        # projection of the mean. returns the position s of the match along the
+        # segment and whether it's good (unique, inside of the candidates)
+        half = _PATCH // 2
+        start = np.clip(np.rint(offset - S / 2), -half, np.maximum(np.ceil(length) + half - S + 1, -half))
+        samples = sample_lines(image, far + start * direction, direction, np.arange(-half, S + half))
+
+        # SSD of the patch at every candidate, sliding window over the samples
+        ssd = np.zeros((S, len(start)), np.float32)
+        difference = np.empty_like(ssd)
+        for j in range(_PATCH):
+            np.subtract(samples[j:j + S], reference[j], out=difference)
+            cv2.accumulateSquare(difference, ssd)
+        # candidates past the end of the segment
+        ssd[np.arange(S)[:, None] > length + half - start + 0.5] = np.inf
+        best = np.argmin(ssd, axis=0)
+        columns = np.arange(len(start))
+        flat = ssd.ravel()
+        best_ssd = flat[best * len(start) + columns]
+        before = flat[np.maximum(best - 1, 0) * len(start) + columns]
+        after = flat[np.minimum(best + 1, S - 1) * len(start) + columns]
+
+        # unique: the second best, away from the best one, must be clearly worse
+        for neighbour in (-1, 0, 1):
+            flat[np.clip(best + neighbour, 0, S - 1) * len(start) + columns] = np.inf
+        second = ssd.min(axis=0)
+        good = (best_ssd < self.max_ssd * _PATCH) & (second > 1.5 * best_ssd) & (best > 0) & (best < S - 1)
+
+        # sub pixel minimum of the parabola through the neighbours
+        good &= np.isfinite(before) & np.isfinite(after)
+        before, after = np.where(good, before, 0), np.where(good, after, 0)
+        curvature = before - 2 * np.where(good, best_ssd, 0) + after
+        shift = np.where(curvature > 0, 0.5 * (before - after) / np.where(curvature > 0, curvature, 1), 0.0)
+        return start + best + np.clip(shift, -0.5, 0.5), good
+
+    @staticmethod
+    def _inverse_depth_at(a, b, far, direction, s):
+        # inverse depth whose projection is the point at s along the segment:
+        # q (a_z + rho b_z) = a_xy + rho b_xy, on the coordinate the line varies most
+        vertical = np.abs(direction[1]) > np.abs(direction[0])
+        q = np.where(vertical, far[1] + s * direction[1], far[0] + s * direction[0])
+        a_axis, b_axis = np.where(vertical, a[1], a[0]), np.where(vertical, b[1], b[0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (a_axis - q * a[2]) / (q * b[2] - b_axis)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Semi-dense inverse depth maps of a video from its VO poses")
+    parser.add_argument("--video", required=True)
+    parser.add_argument("--out", default="depth", help="folder of the keyframe inverse depth maps (.npy)")
+    parser.add_argument("--front-end", choices=FRONT_ENDS, default="klt")
+    parser.add_argument("--keyframe-every", type=int, default=10, help="frames per keyframe")
+    parser.add_argument("--max-inverse-depth", type=float, default=1.0)
+    parser.add_argument("--cell", type=int, default=4,
+                        help="a filter per cell x cell block at most, 1 filters every high gradient pixel")
+    parser.add_argument("--scale", type=float, default=1.0, help="resize the frames by this factor")
+    args = parser.parse_args()
+
+    K = scale_intrinsic_matrix(INTRINSIC_MATRIX, args.scale)
+    vo = VisualOdometry(K, front_end=args.front_end)
+    depth_filter = DepthFilter(K, cell=args.cell, max_inverse_depth=args.max_inverse_depth)
+    os.makedirs(args.out, exist_ok=True)
+
+    def on_frame(frame, pitch_yaw, score):
+        trajectory = vo.trajectory
+        if len(trajectory) == 0 or trajectory.timestamps[-1] != vo.frame_index:
+            # no pose for this frame
+            return
+        pose = trajectory.poses[-1]
+        if depth_filter.keyframe is None or vo.frame_index % args.keyframe_every == 0:
+            if depth_filter.keyframe is not None:
+                np.save(os.path.join(args.out, f"{vo.frame_index:06d}.npy"), depth_filter.inverse_depth)
+            depth_filter.set_keyframe(frame, pose)
+        else:
+            depth_filter.update(frame, pose)
+
+    result = run_sequence(args.video, vo=vo, on_frame=on_frame, scale=args.scale)
+    print(f"{result['frames']} frames, {result['fps']:.1f} fps")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+# Direct (photometric) visual odometry front end, see direct_method.md.
+# Instead of matching features, the camera motion between the reference frame
+# and the current frame is found by minimizing the intensity differences
+#   r(p) = I_cur(w(p; R, t)) - I_ref(p)
+# over semi-dense high gradient pixels p of the reference frame, with
+# Gauss-Newton from the coarsest to the finest level of an image pyramid.
+#
+# The pixels are warped with their inverse depth rho, w(p) = pi(K (R x + rho t))
+# with x = K^-1 p. Without depth (rho = 0, points at infinity) the warp is the
+# infinite homography K R K^-1 and only the rotation is estimated; given
+# inverse depths (e.g. of a depth filter) the full 6 DoF motion is.
+import cv2
+import numpy as np
+
+from roadmap.adv_vo.pose_graph import so3_exp
+from roadmap.basic_vo.bundle_adjustment import huber_weights, skew
+
+
+def level_intrinsics(K, level):
+    # intrinsics of pyramid level `level`, every pyrDown halves the image and
+    # pixel centres move as c -> (c + 0.5) / 2 - 0.5
+    K = np.array(K, dtype=np.float64)
+    scale = 0.5**level
+    K[:2, :2] *= scale
+    K[:2, 2] = (K[:2, 2] + 0.5) * scale - 0.5
+    return K
+
+
+def interpolate(image, u, v):
+    # bilinear samples of the (H,W) float32 image at the (N,) float coordinates,
+    # which must lie inside [0, W - 1) x [0, H - 1)
+    x0, y0 = u.astype(np.int64), v.astype(np.int64)
+    ax, ay = u - x0, v - y0
+    flat = image.ravel()
+    index = y0 * image.shape[1] + x0
+    top = flat[index] * (1 - ax) + flat[index + 1] * ax
+    bottom = flat[index + image.shape[1]] * (1 - ax) + flat[index + image.shape[1] + 1] * ax
+    return top * (1 - ay) + bottom * ay
+
+
+class ImagePyramid:
+    # The pyramid of one frame, built once: the frame is warped into as the
+    # current frame and then reused as the reference of the next one. The
+    # gradients are only computed for reference frames, on first use.
+    def __init__(self, image, levels=4):
+        image = image.astype(np.float32)
+        self.images = [image]
+        for _ in range(1, levels):
+            self.images.append(cv2.pyrDown(self.images[-1]))
+        self._gradients = [None] * levels
+
+    def __len__(self):
+        return len(self.images)
+
+    def gradients(self, level):
+        # (gx, gy) central differences in intensity per pixel
+        if self._gradients[level] is None:
+            image = self.images[level]
+            gx = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=1, scale=0.5)
+            gy = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=1, scale=0.5)
+            self._gradients[level] = gx, gy
+        return self._gradients[level]
+
+
+def select_pixels(gx, gy, cell=8, min_gradient=8.0, border=2):
+    # Semi-dense selection: the pixel with the largest gradient of every
+    # cell x cell block, when the gradient is above min_gradient.
+    # returns the (N,) column and row coordinates
+    height, width = gx.shape
+    rows, cols = (height - 2 * border) // cell, (width - 2 * border) // cell
+    magnitude = np.hypot(gx, gy)[border:border + rows * cell, border:border + cols * cell]
+    blocks = magnitude.reshape(rows, cell, cols, cell).transpose(0, 2, 1, 3).reshape(rows, cols, cell * cell)
+    best = np.argmax(blocks, axis=2)
+    strong = np.take_along_axis(blocks, best[..., None], axis=2)[..., 0] >= min_gradient
+    block_row, block_col = np.nonzero(strong)
+    best = best[strong]
+    v = border + block_row * cell + best // cell
+    u = border + block_col * cell + best % cell
+    return u, v
+
+
+class _ReferenceLevel:
+    # The selected pixels of one level of the reference frame and everything
+    # that doesn't depend on the motion, computed once per reference frame:
+    # intensities, normalized rays x = K^-1 p and the inverse compositional
+    # Jacobians dI/d[t, w] at the identity
+    def __init__(self, pyramid, level, K, cell, min_gradient, inverse_depth):
+        gx, gy = pyramid.gradients(level)
+        u, v = select_pixels(gx, gy, cell, min_gradient)
+        self.K = level_intrinsics(K, level)
+        fx, fy, cx, cy = self.K[0, 0], self.K[1, 1], self.K[0, 2], self.K[1, 2]
+        self.intensities = pyramid.images[level][v, u].astype(np.float64)
+        self.rays = np.column_stack([(u - cx) / fx, (v - cy) / fy, np.ones(len(u))])
+        if np.ndim(inverse_depth) == 2:
+            # a map at the full resolution, sampled at the level's pixels
+            self.inverse_depth = inverse_depth[np.minimum(v << level, len(inverse_depth) - 1),
+                                               np.minimum(u << level, inverse_depth.shape[1] - 1)]
+        else:
+            self.inverse_depth = np.full(len(u), float(inverse_depth))
+
+        # dp/dX at X = x (z = 1), then dX/d[t, w] = [rho I | -[x]x]
+        x, y = self.rays[:, 0], self.rays[:, 1]
+        dI_dX = np.column_stack([gx[v, u] * fx, gy[v, u] * fy,
+                                 -gx[v, u] * fx * x - gy[v, u] * fy * y]).astype(np.float64)
+        self.jacobians = np.hstack([dI_dX * self.inverse_depth[:, None],
+                                    -(dI_dX[:, None, :] @ skew(self.rays))[:, 0]])
+
+    def __len__(self):
+        return len(self.intensities)
+
+
+class DirectOdometry:
+    # Frame to frame direct alignment. track(image) aligns the frame to the
+    # previous one and returns the motion (R, t), x_cur = R x_ref + t, as
+    # the essential matrix decomposition of the feature based front ends.
+    #   levels: pyramid levels, the alignment runs from the coarsest one
+    #     down to finest_level (1 skips the full resolution)
+    #   cell, min_gradient: a pixel per cell x cell block of every level
+    #     when its gradient is strong enough
+    #   loss_scale: intensity residual above which the Huber loss is linear
+    #   inverse_depth: inverse depth of the reference pixels without a depth
+    #     map, 0 puts them at infinity and estimates the rotation only
+    #   min_inlier_ratio: below this ratio of pixels within loss_scale the
+    #     alignment failed, track returns (None, None)
+    def __init__(self, K, levels=4, finest_level=0, iterations=10, cell=8, min_gradient=8.0, loss_scale=10.0,
+                 inverse_depth=0.0, min_inlier_ratio=0.3, min_pixels=50):
+        self.K = np.asarray(K, dtype=np.float64)
+        self.levels = levels
+        self.finest_level = finest_level
+        self.iterations = iterations
+        self.cell = cell
+        self.min_gradient = min_gradient
+        self.loss_scale = loss_scale
+        self.inverse_depth = inverse_depth
+        self.min_inlier_ratio = min_inlier_ratio
+        self.min_pixels = min_pixels
+
+        self.reference = None
+        self._reference_levels = None
+        # inverse depth maps of the reference and of the next reference, see set_inverse_depth
+        self._reference_depth = None
+        self._next_inverse_depth = None
+        # the motion of the last frame pair, initial guess of the next one
+        self.motion = np.eye(4)
+        # statistics of the last track() call
+        self.inlier_count = 0
+        self.inlier_ratio = 0.0
+
+    def set_inverse_depth(self, inverse_depth):
+        # (H,W) inverse depth map of the current frame at full resolution
+        # (0 where unknown), used once the frame becomes the reference
+        self._next_inverse_depth = inverse_depth
+
+    def _reference_level(self, level):
+        if self._reference_levels[level] is None:
+            inverse_depth = self.inverse_depth if self._reference_depth is None else self._reference_depth
+            self._reference_levels[level] = _ReferenceLevel(self.reference, level, self.K, self.cell,
+                                                            self.min_gradient, inverse_depth)
+        return self._reference_levels[level]
+
+    def align_level(self, reference, image, T):
+        # Gauss-Newton on one pyramid level from the motion T (4,4), returns
+        # the refined motion and the inlier mask of the reference pixels
+        height, width = image.shape
+        fx, fy, cx, cy = reference.K[0, 0], reference.K[1, 1], reference.K[0, 2], reference.K[1, 2]
+        # points at infinity don't constrain the translation
+        free = slice(0, 6) if np.any(reference.inverse_depth > 0) else slice(3, 6)
+        J = reference.jacobians[:, free]
+        inliers = np.zeros(len(reference), bool)
+        for _ in range(self.iterations):
+            X = reference.rays @ T[:3, :3].T + reference.inverse_depth[:, None] * T[:3, 3]
+            z = np.maximum(X[:, 2], 1e-9)
+            u = fx * X[:, 0] / z + cx
+            v = fy * X[:, 1] / z + cy
+            inside = (X[:, 2] > 1e-9) & (u >= 0) & (u < width - 1) & (v >= 0) & (v < height - 1)
+            if np.count_nonzero(inside) < self.min_pixels:
+                break
+            residuals = np.zeros(len(reference))
+            residuals[inside] = interpolate(image, u[inside], v[inside]) - reference.intensities[inside]
+            weights = huber_weights(np.abs(residuals), self.loss_scale) * inside
+            inliers = inside & (np.abs(residuals) <= self.loss_scale)
+
+            # inverse compositional step: the increment applies to the reference
+            H = (J * weights[:, None]).T @ J
+            g = (J * weights[:, None]).T @ residuals
+            try:
+                delta = np.zeros(6)
+                delta[free] = np.linalg.solve(H, g)
+            except np.linalg.LinAlgError:
+                break
+            # T <- T exp(delta)^-1
+            step = np.eye(4)
+            step[:3, :3] = so3_exp(delta[None, 3:])[0]
+            step[:3, 3] = delta[:3]
+            T = T @ np.linalg.inv(step)
+            if np.max(np.abs(delta)) < 1e-6:
+                break
+        return T, inliers
+
+    def align(self, pyramid, T):
+        # coarse to fine alignment of the reference to the current frame's
+        # pyramid from the motion T, returns the motion and the inlier ratio
+        inliers = np.zeros(0, bool)
+        for level in range(self.levels - 1, self.finest_level - 1, -1):
+            reference = self._reference_level(level)
+            if len(reference) < self.min_pixels:
+                continue
+            T, inliers = self.align_level(reference, pyramid.images[level], T)
+        self.inlier_count = int(np.count_nonzero(inliers))
+        self.inlier_ratio = self.inlier_count / max(len(inliers), 1)
+        return T, self.inlier_ratio
+
+    def track(self, image):
+        # returns None for the first frame, (R, t) or (None, None) afterwards
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        pyramid = ImagePyramid(image, self.levels)
+        if self.reference is None:
+            self._set_reference(pyramid)
+            return None
+
+        # from the last motion (constant velocity), then from rest when that fails
+        T, inlier_ratio = self.align(pyramid, self.motion)
+        if inlier_ratio < self.min_inlier_ratio and not np.array_equal(self.motion, np.eye(4)):
+            T, inlier_ratio = self.align(pyramid, np.eye(4))
+        self._set_reference(pyramid)
+        if inlier_ratio < self.min_inlier_ratio:
+            self.motion = np.eye(4)
+            return None, None
+        self.motion = T
+        return T[:3, :3].copy(), T[:3, 3:].copy()
+
+    def _set_reference(self, pyramid):
+        self.reference = pyramid
+        self._reference_levels = [None] * len(pyramid)
+        self._reference_depth, self._next_inverse_depth = self._next_inverse_depth, None
@@ -0,0 +1,308 @@
+# Place recognition for loop closure detection: a vocabulary tree of binary
+# words (bag of binary words, Galvez-Lopez & Tardos 2012) learnt from ORB
+# descriptors, an inverted file index over the keyframes and a geometric
+# verification of the candidates with the fundamental matrix RANSAC.
+#
+#   python -m roadmap.adv_vo.place_recognition --videos a.hevc b.hevc --out vocabulary.npz
+import argparse
+
+import cv2
+import numpy as np
+
+from roadmap.basic_vo.matching import NumpyHammingMatcher, popcount64
+from roadmap.basic_vo.ops import FeatureExtractor, match_descriptors, estimate_fundamental_with_ransac
+
+
+def _hamming(words1, words2):
+    # (n,m) Hamming distances of two sets of uint64 word descriptors
+    return popcount64(words1[:, None, :] ^ words2[None, :, :]).sum(axis=2, dtype=np.int32)
+
+
+def _kmajority(des, k, iterations, rng):
+    # k-majority clustering (k-means for binary strings): centres are the
+    # bitwise majority of their cluster, initialized with k-means++.
+    # returns the (c,32) uint8 centres, c <= k when there are few descriptors
+    words = NumpyHammingMatcher.as_words(des)
+    first = rng.integers(len(des))
+    centers = [first]
+    closest = _hamming(words, words[[first]])[:, 0].astype(np.float64)
+    while len(centers) < k and closest.sum() > 0:
+        new = rng.choice(len(des), p=closest**2 / (closest**2).sum())
+        centers.append(new)
+        closest = np.minimum(closest, _hamming(words, words[[new]])[:, 0])
+    centers = des[centers]
+
+    bits = np.unpackbits(des, axis=1).astype(np.float32)
+    for _ in range(iterations):
+        assign = np.argmin(_hamming(words, NumpyHammingMatcher.as_words(centers)), axis=1)
+        one_hot = np.zeros((len(centers), len(des)), np.float32)
+        one_hot[assign, np.arange(len(des))] = 1
+        sizes = one_hot.sum(axis=1)
+        votes = one_hot @ bits
+        new_centers = np.packbits(votes * 2 > sizes[:, None], axis=1)
+        # empty clusters keep their centre
+        new_centers[sizes == 0] = centers[sizes == 0]
+        if np.array_equal(new_centers, centers):
+            break
+        centers = new_centers
+    return centers
+
+
+class BinaryVocabulary:
+    # Vocabulary tree with `branching` children per node and `depth` levels,
+    # the leaves are the words. The nodes are stored level by level in heap
+    # order (children of node i are i*k+1 .. i*k+k), unused nodes are marked
+    # invalid, so the whole tree is three flat arrays.
+    def __init__(self, branching=10, depth=5):
+        self.branching = branching
+        self.depth = depth
+        n_nodes = (branching**(depth + 1) - 1) // (branching - 1)
+        self.centers = np.zeros((n_nodes, 32), np.uint8)
+        self.valid = np.zeros(n_nodes, bool)
+        self.valid[0] = True
+        self.first_leaf = (branching**depth - 1) // (branching - 1)
+        # inverse document frequency of every word, 0 for words never seen in training
+        self.idf = np.zeros(branching**depth, np.float32)
+
+    @property
+    def n_words(self):
+        return len(self.idf)
+
+    def train(self, descriptors_per_image, iterations=10, seed=0):
+        # descriptors_per_image: list of (N,32) uint8 ORB descriptors, one per training image
+        rng = np.random.default_rng(seed)
+        des = np.concatenate(descriptors_per_image)
+        k = self.branching
+        # descriptors of every node of the current level
+        members = {0: np.arange(len(des))}
+        for _ in range(self.depth):
+            next_members = {}
+            for node, idx in members.items():
+                centers = _kmajority(des[idx], k, iterations, rng)
+                children = node * k + 1 + np.arange(len(centers))
+                self.centers[children] = centers
+                self.valid[children] = True
+                assign = np.argmin(_hamming(NumpyHammingMatcher.as_words(des[idx]),
+                                            NumpyHammingMatcher.as_words(centers)), axis=1)
+                for c, child in enumerate(children):
+                    if np.any(assign == c):
+                        next_members[child] = idx[assign == c]
+            members = next_members
+
+        # idf = log(N images / images containing the word)
+        containing = np.zeros(self.n_words)
+        for image_des in descriptors_per_image:
+            containing[np.unique(self.transform(image_des))] += 1
+        with np.errstate(divide='ignore'):
+            self.idf = np.where(containing > 0, np.log(len(descriptors_per_image) / containing), 0).astype(np.float32)
+        return self
+
+    def transform(self, des):
+        # word id of every descriptor, the tree is descended one level at a time for all of them
+        words = NumpyHammingMatcher.as_words(des)
+        center_words = NumpyHammingMatcher.as_words(self.centers)
+        k = self.branching
+        node = np.zeros(len(des), np.int64)
+        for _ in range(self.depth):
+            children = node[:, None] * k + 1 + np.arange(k)
+            distances = popcount64(words[:, None, :] ^ center_words[children]).sum(axis=2, dtype=np.int32)
+            distances[~self.valid[children]] = np.iinfo(np.int32).max
+            node = children[np.arange(len(des)), np.argmin(distances, axis=1)]
+        return node - self.first_leaf
+
+    def bow_vector(self, des):
+        # sparse tf-idf bag of words, L1 normalized: (word ids, weights)
+        words, counts = np.unique(self.transform(des), return_counts=True)
+        weights = counts * self.idf[words]
+        keep = weights > 0
+        words, weights = words[keep], weights[keep]
+        total = weights.sum()
+        return words, (weights / total if total > 0 else weights).astype(np.float32)
+
+    def save(self, path):
+        # compact npz: only the valid nodes are stored
+        nodes = np.flatnonzero(self.valid)
+        np.savez_compressed(path, branching=self.branching, depth=self.depth, nodes=nodes,
+                            centers=self.centers[nodes], idf=self.idf)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        vocabulary = cls(int(data["branching"]), int(data["depth"]))
+        vocabulary.valid[:] = False
+        vocabulary.valid[data["nodes"]] = True
+        vocabulary.centers[data["nodes"]] = data["centers"]
+        vocabulary.idf = data["idf"]
+        return vocabulary
+
+
+class KeyframeDatabase:
+    # Inverted file over the bag of words of the keyframes. A query only
+    # visits the postings of its own words, so it is sublinear in the number
+    # of keyframes. The postings are kept in a few runs sorted by word, of
+    # geometrically growing sizes (log structured): new postings are buffered
+    # and become a run once there are `run_size` of them, and two runs of
+    # similar size are merged, so adding is amortized O(log n) per posting and
+    # a query does O(log n) binary searches per word instead of a full scan.
+    def __init__(self, vocabulary, run_size=1024):
+        self.vocabulary = vocabulary
+        self.run_size = run_size
+        self.count = 0
+        # (words, keyframes, weights) arrays sorted by word
+        self.runs = []
+        self._pending = []
+        self._pending_size = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, des):
+        # adds a keyframe from its ORB descriptors, returns its id
+        words, weights = self.vocabulary.bow_vector(des)
+        keyframe = self.count
+        self.count += 1
+        self._pending.append((words, np.full(len(words), keyframe, np.int32), weights))
+        self._pending_size += len(words)
+        if self._pending_size >= self.run_size:
+            self._push_run(*self._pending_postings())
+            self._pending, self._pending_size = [], 0
+        return keyframe
+
+    def _pending_postings(self):
+        if not self._pending:
+            return np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.float32)
+        return tuple(np.concatenate(column) for column in zip(*self._pending))
+
+    def _push_run(self, words, keyframes, weights):
+        order = np.argsort(words, kind="stable")
+        self.runs.append((words[order], keyframes[order], weights[order]))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            words = np.concatenate([older[0], newer[0]])
+            # stable: the postings of a word stay in keyframe order
+            order = np.argsort(words, kind="stable")
+            self.runs.append((words[order], np.concatenate([older[1], newer[1]])[order],
+                              np.concatenate([older[2], newer[2]])[order]))
+
+    def _postings(self, words):
+        # (query word index, keyframe, weight) of all the postings of `words`
+        found = []
+        for run_words, run_keyframes, run_weights in self.runs:
+            starts = np.searchsorted(run_words, words, side="left")
+            counts = np.searchsorted(run_words, words, side="right") - starts
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            first = np.repeat(np.cumsum(counts) - counts, counts)
+            postings = np.repeat(starts, counts) + (np.arange(total) - first)
+            found.append((np.repeat(np.arange(len(words)), counts), run_keyframes[postings], run_weights[postings]))
+        pending_words, pending_keyframes, pending_weights = self._pending_postings()
+        if len(pending_words):
+            index = np.searchsorted(words, pending_words)
+            hit = (index < len(words)) & (words[np.minimum(index, len(words) - 1)] == pending_words)
+            found.append((index[hit], pending_keyframes[hit], pending_weights[hit]))
+        if not found:
+            return np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.float32)
+        return tuple(np.concatenate(column) for column in zip(*found))
+
+    def query(self, des, top_k=5, max_keyframe=None):
+        # the top_k keyframes by L1 bag of words score, s = sum over the common
+        # words of min(q_w, v_w) (= 1 - |q - v|_1 / 2 for L1 normalized vectors).
+        # keyframes with an id >= max_keyframe are ignored (e.g. the recent ones).
+        # returns (keyframe ids, scores), best first
+        words, weights = self.vocabulary.bow_vector(des)
+        word_index, keyframes, keyframe_weights = self._postings(words)
+        if len(keyframes) == 0:
+            return np.empty(0, np.int64), np.empty(0, np.float32)
+        contributions = np.minimum(weights[word_index], keyframe_weights)
+
+        scores = np.bincount(keyframes, weights=contributions, minlength=self.count)
+        if max_keyframe is not None:
+            scores[max(max_keyframe, 0):] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return candidates, scores[candidates].astype(np.float32)
+
+
+def verify_loop(features1, features2, min_inliers=30, ratio=0.75):
+    # geometric verification of a loop candidate with the fundamental matrix
+    # RANSAC of the VO. returns (F, inlier count) or None
+    query_idx, train_idx, _ = match_descriptors(features1.descriptors, features2.descriptors, ratio)
+    if len(query_idx) < max(min_inliers, 8):
+        return None
+    try:
+        fundamental_mat, inlier_mask = estimate_fundamental_with_ransac(features1.points[query_idx],
+                                                                       features2.points[train_idx])
+    except ValueError:
+        return None
+    inliers = int(np.count_nonzero(inlier_mask))
+    if inliers < min_inliers:
+        return None
+    return fundamental_mat, inliers
+
+
+class LoopDetector:
+    # Keyframes are added one by one, every new one is queried against the
+    # keyframes older than min_gap and the best candidates are verified
+    # geometrically. The keyframe features are kept for the verification.
+    def __init__(self, vocabulary, min_score=0.05, min_gap=50, top_k=3, min_inliers=30):
+        self.database = KeyframeDatabase(vocabulary)
+        self.min_score = min_score
+        self.min_gap = min_gap
+        self.top_k = top_k
+        self.min_inliers = min_inliers
+        self.features = []
+
+    def process(self, features):
+        # adds the keyframe, returns (its id, loop keyframe id, F, inliers),
+        # the last three are None without a verified loop
+        candidates, scores = self.database.query(features.descriptors, self.top_k,
+                                                 max_keyframe=len(self.database) - self.min_gap)
+        keyframe = self.database.add(features.descriptors)
+        self.features.append(features)
+        for candidate, score in zip(candidates, scores):
+            if score < self.min_score:
+                break
+            verified = verify_loop(features, self.features[candidate], self.min_inliers)
+            if verified is not None:
+                return keyframe, int(candidate), verified[0], verified[1]
+        return keyframe, None, None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a binary vocabulary from the ORB descriptors of videos")
+    parser.add_argument("--videos", nargs="+", required=True)
+    parser.add_argument("--out", default="vocabulary.npz")
+    parser.add_argument("--branching", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--every", type=int, default=10, help="use one frame out of `every`")
+    parser.add_argument("--nfeatures", type=int, default=500)
+    args = parser.parse_args()
+
+    extractor = FeatureExtractor(nfeatures=args.nfeatures)
+    descriptors = []
+    for video_path in args.videos:
+        cap = cv2.VideoCapture(video_path)
+        index = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if index % args.every == 0:
+                des = extractor.detectAndCompute(frame).descriptors
+                if des is not None and len(des):
+                    descriptors.append(des)
+            index += 1
+        cap.release()
+    print(f"training on {sum(len(d) for d in descriptors)} descriptors of {len(descriptors)} frames")
+
+    vocabulary = BinaryVocabulary(args.branching, args.depth).train(descriptors)
+    vocabulary.save(args.out)
+    print(f"{np.count_nonzero(vocabulary.idf)} words saved to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+# Pose graph optimization: the nodes are camera poses (e.g. the keyframes of
+# the VO trajectory), the edges measured relative poses between them, from
+# the odometry or from loop closures (see place_recognition.py). The poses
+# are refined by Levenberg-Marquardt on the SE(3) edge residuals, the normal
+# equations are a scipy.sparse matrix with one 6x6 block per node and per
+# edge, so memory and time grow with the number of edges, never with N^2.
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
+
+from roadmap.basic_vo.bundle_adjustment import skew
+from roadmap.basic_vo.trajectory import Trajectory
+
+SOLVERS = ("cg", "direct")
+
+
+def so3_exp(w):
+    # (N,3) rotation vectors to (N,3,3) rotation matrices (Rodrigues formula)
+    theta = np.linalg.norm(w, axis=1)[:, None, None]
+    small = theta < 1e-6
+    safe = np.where(small, 1.0, theta)
+    a = np.where(small, 1.0 - theta**2 / 6, np.sin(safe) / safe)
+    b = np.where(small, 0.5 - theta**2 / 24, (1 - np.cos(safe)) / safe**2)
+    W = skew(w)
+    return np.eye(3) + a * W + b * (W @ W)
+
+
+def so3_log(R):
+    # (N,3,3) rotation matrices to (N,3) rotation vectors, angles in [0, pi]
+    v = np.stack([R[:, 2, 1] - R[:, 1, 2], R[:, 0, 2] - R[:, 2, 0], R[:, 1, 0] - R[:, 0, 1]], axis=1)
+    sin = 0.5 * np.linalg.norm(v, axis=1)
+    cos = 0.5 * (np.trace(R, axis1=1, axis2=2) - 1)
+    theta = np.arctan2(sin, cos)
+    # theta / sin(theta) -> 1 for small angles
+    scale = np.where(sin < 1e-12, 0.5, 0.5 * theta / np.maximum(sin, 1e-12))
+    w = scale[:, None] * v
+
+    # close to pi the antisymmetric part vanishes, the axis is read from the
+    # symmetric part (R + R^T) / 2 = cos I + (1 - cos) n n^T instead
+    near_pi = cos < -0.99
+    if np.any(near_pi):
+        Rs, c = R[near_pi], cos[near_pi]
+        nn = (0.5 * (Rs + np.swapaxes(Rs, 1, 2)) - c[:, None, None] * np.eye(3)) / (1 - c)[:, None, None]
+        column = np.argmax(np.diagonal(nn, axis1=1, axis2=2), axis=1)
+        n = nn[np.arange(len(nn)), :, column]
+        n /= np.linalg.norm(n, axis=1, keepdims=True)
+        n *= np.where(np.sum(n * v[near_pi], axis=1) < 0, -1.0, 1.0)[:, None]
+        w[near_pi] = theta[near_pi, None] * n
+    return w
+
+
+def so3_right_jacobian_inv(w):
+    # (N,3,3) inverse right Jacobians of SO(3), d log(exp(w) exp(d)) / dd at d = 0
+    theta = np.linalg.norm(w, axis=1)[:, None, None]
+    small = theta < 1e-4
+    safe = np.where(small, 1.0, theta)
+    c = np.where(small, 1.0 / 12, 1 / safe**2 - (1 + np.cos(safe)) / (2 * safe * np.maximum(np.sin(safe), 1e-9)))
+    W = skew(w)
+    return np.eye(3) + 0.5 * W + c * (W @ W)
+
+
+class PoseGraph:
+    # Node i is the camera to world pose T_i = [R_i|t_i] (as in Trajectory),
+    # edge k between nodes i and j the measured relative pose Z_k = T_i^-1 T_j
+    # with a (6,6) information matrix over the residual
+    #   e_t = dR^T (R_i^T (t_j - t_i) - dt)   (translation, frame of i)
+    #   e_R = log(dR^T R_i^T R_j)              (rotation)
+    # where Z_k = [dR|dt]. The poses are perturbed as t += d_t, R = R exp(d_R).
+    # The fixed nodes (the first one by default) set the gauge.
+    #
+    # The damped normal equations are solved with a sparse LU factorization
+    # (solver="direct", scipy has no sparse Cholesky) or with block Jacobi
+    # preconditioned conjugate gradient (solver="cg"), which never forms a
+    # factor but needs many iterations on long chains.
+    #
+    # Re-optimizing after new edges is incremental:
+    #   - optimize() starts from the current poses. After odometry edges the
+    #     graph is still at its last optimum and it returns without solving,
+    #     after a loop closure a few iterations spread the correction,
+    #   - the 6x6 Hessian blocks of an edge are cached and only relinearized
+    #     once one of its poses moved more than relinearize_threshold since
+    #     (fluid relinearization). The gradient is always exact, so the
+    #     optimum doesn't depend on it,
+    #   - the sparsity pattern of the Hessian (CSR indices and the slot of
+    #     every block entry) is only rebuilt when edges or nodes are added and
+    #     the stale blocks are folded into its data as differences.
+    def __init__(self, capacity=1024, solver="direct", relinearize_threshold=1e-3, cg_iterations=200):
+        if solver not in SOLVERS:
+            raise ValueError(f"unknown solver {solver}, expected one of {SOLVERS}")
+        self.solver = solver
+        self.relinearize_threshold = relinearize_threshold
+        # inexact steps: the LM loop rejects the ones that don't lower the cost
+        self.cg_iterations = cg_iterations
+        self._R = np.empty((capacity, 3, 3))
+        self._t = np.empty((capacity, 3))
+        # motion of every node since the blocks of its edges were computed
+        self._moved = np.zeros(capacity)
+        self._fixed = np.zeros(capacity, bool)
+        self.node_count = 0
+
+        self._pairs = np.empty((capacity, 2), np.int64)
+        self._dR = np.empty((capacity, 3, 3))
+        self._dt = np.empty((capacity, 3))
+        self._information = np.empty((capacity, 6, 6))
+        # Hessian blocks [ii, ij, ji, jj] of every edge at its last linearization
+        self._blocks = np.zeros((capacity, 4, 6, 6))
+        self._stale = np.ones(capacity, bool)
+        self.edge_count = 0
+
+        self._structure = None
+        self._H_data = None
+        # cost of the last converged optimize()
+        self._optimum = None
+
+    def __len__(self):
+        return self.node_count
+
+    @classmethod
+    def from_trajectory(cls, trajectory, information=None, **kwargs):
+        # a chain of the trajectory poses linked by their relative odometry poses
+        graph = cls(capacity=max(len(trajectory), 1), **kwargs)
+        poses = trajectory.poses
+        for pose in poses:
+            graph.add_node(pose)
+        if len(poses) > 1:
+            relative = np.linalg.inv(poses[:-1]) @ poses[1:]
+            graph.add_edges(np.arange(len(poses) - 1), np.arange(1, len(poses)), relative, information)
+        return graph
+
+    @property
+    def poses(self):
+        # (N,4,4) camera to world poses
+        poses = np.zeros((self.node_count, 4, 4))
+        poses[:, :3, :3] = self._R[:self.node_count]
+        poses[:, :3, 3] = self._t[:self.node_count]
+        poses[:, 3, 3] = 1
+        return poses
+
+    @property
+    def edges(self):
+        # (E,2) node indices of the edges
+        return self._pairs[:self.edge_count]
+
+    def to_trajectory(self, timestamps=None):
+        trajectory = Trajectory(capacity=max(self.node_count, 1))
+        timestamps = np.arange(self.node_count) if timestamps is None else timestamps
+        for pose, timestamp in zip(self.poses, timestamps):
+            trajectory.append(pose, timestamp)
+        return trajectory
+
+    @staticmethod
+    def _grown(array, size):
+        if size <= len(array):
+            return array
+        grown = np.zeros((max(2 * len(array), size),) + array.shape[1:], array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def add_node(self, pose, fixed=None):
+        # pose is the (4,4) or (3,4) camera to world pose, returns the node index.
+        # the first node is fixed unless told otherwise
+        n = self.node_count + 1
+        self._R, self._t = self._grown(self._R, n), self._grown(self._t, n)
+        self._moved, self._fixed = self._grown(self._moved, n), self._grown(self._fixed, n)
+        pose = np.asarray(pose, dtype=np.float64)
+        self._R[n - 1], self._t[n - 1] = pose[:3, :3], pose[:3, 3]
+        self._moved[n - 1] = 0
+        self._fixed[n - 1] = n == 1 if fixed is None else fixed
+        self.node_count = n
+        self._structure = None
+        return n - 1
+
+    def fix(self, node, fixed=True):
+        self._fixed[node] = fixed
+        self._structure = None
+        self._optimum = None
+
+    def add_edge(self, i, j, relative, information=None):
+        # relative is the (4,4) pose of node j in the frame of node i,
+        # information a scalar or (6,6) matrix (identity by default)
+        return self.add_edges([i], [j], np.asarray(relative)[None], information)[0]
+
+    def add_edges(self, i, j, relative, information=None):
+        # vectorized add_edge of (E,) node indices and (E,4,4) relative poses,
+        # information is None, a scalar, (6,6) or (E,6,6)
+        i, j = np.atleast_1d(i), np.atleast_1d(j)
+        relative = np.asarray(relative, dtype=np.float64)
+        if len(i) and max(i.max(), j.max()) >= self.node_count:
+            raise IndexError("edge to a node that doesn't exist")
+        begin, end = self.edge_count, self.edge_count + len(i)
+        for name in ("_pairs", "_dR", "_dt", "_information", "_blocks", "_stale"):
+            setattr(self, name, self._grown(getattr(self, name), end))
+        self._pairs[begin:end, 0], self._pairs[begin:end, 1] = i, j
+        self._dR[begin:end] = relative[:, :3, :3]
+        self._dt[begin:end] = relative[:, :3, 3]
+        information = np.asarray(1.0 if information is None else information, dtype=np.float64)
+        self._information[begin:end] = information * np.eye(6) if information.ndim == 0 else information
+        self._blocks[begin:end] = 0
+        self._stale[begin:end] = True
+        self.edge_count = end
+        self._structure = None
+        return np.arange(begin, end)
+
+    def add_odometry(self, relative, information=None):
+        # appends the node reached from the last one by the relative pose and
+        # the edge between them, returns the new node index
+        relative = np.asarray(relative, dtype=np.float64)
+        last = self.node_count - 1
+        pose = np.eye(4)
+        pose[:3, :3] = self._R[last] @ relative[:3, :3]
+        pose[:3, 3] = self._R[last] @ relative[:3, 3] + self._t[last]
+        node = self.add_node(pose)
+        self.add_edge(node - 1, node, relative, information)
+        return node
+
+    def _residuals(self, R, t):
+        # (E,6) residuals [e_t, e_R] of all the edges for the poses R, t
+        i, j = self.edges[:, 0], self.edges[:, 1]
+        dR_T = np.swapaxes(self._dR[:self.edge_count], 1, 2)
+        Ri_T = np.swapaxes(R[i], 1, 2)
+        local = (Ri_T @ (t[j] - t[i])[:, :, None])[..., 0]
+        e_t = (dR_T @ (local - self._dt[:self.edge_count])[:, :, None])[..., 0]
+        e_R = so3_log(dR_T @ Ri_T @ R[j])
+        return np.hstack([e_t, e_R]), local
+
+    def _jacobians(self, R, residuals, local):
+        # (E,6,6) Jacobians A = de/dx_i and B = de/dx_j, x = [d_t, d_R]
+        i, j = self.edges[:, 0], self.edges[:, 1]
+        dR_T = np.swapaxes(self._dR[:self.edge_count], 1, 2)
+        Ri_T = np.swapaxes(R[i], 1, 2)
+        Jr_inv = so3_right_jacobian_inv(residuals[:, 3:])
+        E = self.edge_count
+        A, B = np.zeros((E, 6, 6)), np.zeros((E, 6, 6))
+        rotate = dR_T @ Ri_T
+        A[:, :3, :3] = -rotate
+        A[:, :3, 3:] = dR_T @ skew(local)
+        A[:, 3:, 3:] = -Jr_inv @ np.swapaxes(R[j], 1, 2) @ R[i]
+        B[:, :3, :3] = rotate
+        B[:, 3:, 3:] = Jr_inv
+        return A, B
+
+    def _cost(self, residuals):
+        return 0.5 * np.einsum('ni,nij,nj->', residuals, self._information[:self.edge_count], residuals)
+
+    def _build_structure(self):
+        # CSR pattern of the Hessian over the free nodes and, for every entry
+        # of the (E,4,6,6) edge blocks, its slot in the CSR data (-1 when it
+        # belongs to a fixed node)
+        n = self.node_count
+        free = ~self._fixed[:n]
+        column = np.full(n, -1)
+        column[free] = np.arange(np.count_nonzero(free))
+        dim = 6 * np.count_nonzero(free)
+
+        i, j = column[self.edges[:, 0]], column[self.edges[:, 1]]
+        rows_node = np.stack([i, i, j, j], axis=1)
+        cols_node = np.stack([i, j, i, j], axis=1)
+        offsets = np.arange(6)
+        shape = (len(i), 4, 6, 6)
+        rows = np.broadcast_to(6 * rows_node[:, :, None, None] + offsets[:, None], shape)
+        cols = np.broadcast_to(6 * cols_node[:, :, None, None] + offsets, shape)
+        valid = np.broadcast_to(((rows_node >= 0) & (cols_node >= 0))[:, :, None, None], shape).ravel()
+
+        # the diagonal is always in the pattern for the damping
+        diagonal = np.arange(dim)
+        keys = np.concatenate([(rows.ravel() * dim + cols.ravel())[valid], diagonal * dim + diagonal])
+        unique, inverse = np.unique(keys, return_inverse=True)
+        slots = np.full(valid.size, -1)
+        slots[valid] = inverse[:np.count_nonzero(valid)]
+        indptr = np.searchsorted(unique // max(dim, 1), np.arange(dim + 1))
+        self._structure = {
+            "dim": dim, "slots": slots, "diagonal": inverse[-dim:] if dim else inverse[:0],
+            "indptr": indptr, "indices": unique % max(dim, 1),
+        }
+        self._H_data = np.bincount(slots[valid], self._blocks[:self.edge_count].ravel()[valid],
+                                   minlength=len(unique))
+
+    def _relinearize(self, A, B):
+        # recomputes the blocks of the stale edges and folds the differences
+        # into the cached Hessian data
+        stale = np.flatnonzero(self._stale[:self.edge_count])
+        if len(stale) == 0:
+            return
+        Omega = self._information[stale]
+        OA, OB = Omega @ A[stale], Omega @ B[stale]
+        A_T, B_T = np.swapaxes(A[stale], 1, 2), np.swapaxes(B[stale], 1, 2)
+        blocks = np.stack([A_T @ OA, A_T @ OB, B_T @ OA, B_T @ OB], axis=1)
+
+        slots = self._structure["slots"].reshape(-1, 144)[stale].ravel()
+        difference = (blocks - self._blocks[stale]).ravel()
+        valid = slots >= 0
+        self._H_data += np.bincount(slots[valid], difference[valid], minlength=len(self._H_data))
+        self._blocks[stale] = blocks
+        self._stale[stale] = False
+
+    def _gradient(self, A, B, residuals):
+        # (dim,) gradient J^T Omega e over the free nodes
+        Oe = (self._information[:self.edge_count] @ residuals[:, :, None])[..., 0]
+        g_i = (np.swapaxes(A, 1, 2) @ Oe[:, :, None])[..., 0]
+        g_j = (np.swapaxes(B, 1, 2) @ Oe[:, :, None])[..., 0]
+        index = (6 * self.edges[:, :, None] + np.arange(6)).ravel()
+        g = np.bincount(index, np.stack([g_i, g_j], axis=1).ravel(), minlength=6 * self.node_count)
+        return g.reshape(-1, 6)[~self._fixed[:self.node_count]].ravel()
+
+    def _solve(self, g, damping):
+        # solves (H + damping diag(H)) dx = -g
+        structure = self._structure
+        data = self._H_data.copy()
+        diagonal = data[structure["diagonal"]]
+        data[structure["diagonal"]] += damping * np.maximum(diagonal, 1e-9)
+        H = sparse.csr_matrix((data, structure["indices"], structure["indptr"]),
+                              shape=(structure["dim"], structure["dim"]))
+        if self.solver == "direct":
+            # scipy has no sparse Cholesky, SuperLU with a symmetric
+            # minimum degree ordering keeps the fill-in of the chain low
+            lu = sparse_linalg.splu(H.tocsc(), permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0,
+                                    options={"SymmetricMode": True})
+            return lu.solve(-g)
+
+        # conjugate gradient preconditioned by the inverses of the 6x6
+        # diagonal blocks of H, summed from the ii and jj edge blocks
+        index = (36 * self.edges[:, :, None] + np.arange(36)).ravel()
+        diagonal_blocks = self._blocks[:self.edge_count][:, [0, 3]].ravel()
+        blocks = np.bincount(index, diagonal_blocks, minlength=36 * self.node_count).reshape(-1, 6, 6)
+        blocks = blocks[~self._fixed[:self.node_count]]
+        blocks[:, np.arange(6), np.arange(6)] *= 1 + damping
+        blocks = np.linalg.inv(blocks + 1e-9 * np.eye(6))
+        preconditioner = sparse_linalg.LinearOperator(
+            H.shape, matvec=lambda x: (blocks @ x.reshape(-1, 6, 1)).ravel(), dtype=np.float64)
+        dx, _ = sparse_linalg.cg(H, -g, rtol=1e-8, maxiter=self.cg_iterations, M=preconditioner)
+        return dx
+
+    def optimize(self, iterations=20, tolerance=1e-6):
+        # refines the poses in place from their current values, returns the
+        # final cost 0.5 sum e^T Omega e. Stops when an iteration lowers the
+        # cost by less than `tolerance` (relative)
+        n = self.node_count
+        R, t = self._R[:n].copy(), self._t[:n].copy()
+        residuals, local = self._residuals(R, t)
+        cost = self._cost(residuals)
+        if self._optimum is not None and cost <= self._optimum * (1 + 1e-9):
+            # nothing but consistent edges (e.g. odometry) since the last optimum
+            return cost
+        if self._structure is None:
+            self._build_structure()
+        if self.edge_count == 0 or self._structure["dim"] == 0:
+            return cost
+        free = ~self._fixed[:n]
+        damping = 1e-4
+        A, B = self._jacobians(R, residuals, local)
+        g = self._gradient(A, B, residuals)
+        converged = False
+        for _ in range(iterations):
+            self._relinearize(A, B)
+            try:
+                dx = self._solve(g, damping).reshape(-1, 6)
+            except (RuntimeError, np.linalg.LinAlgError):
+                break
+
+            R_new, t_new = R.copy(), t.copy()
+            t_new[free] += dx[:, :3]
+            R_new[free] = R[free] @ so3_exp(dx[:, 3:])
+            new_residuals, new_local = self._residuals(R_new, t_new)
+            new_cost = self._cost(new_residuals)
+            if not new_cost < cost:
+                # rejected, closer to gradient descent
+                damping *= 10
+                converged = damping > 1e8
+                if converged:
+                    break
+                continue
+            converged = cost - new_cost < tolerance * cost
+            R, t, residuals, local, cost = R_new, t_new, new_residuals, new_local, new_cost
+            damping = max(damping / 10, 1e-8)
+
+            # the edges of the nodes that moved enough get new Hessian blocks
+            self._moved[:n][free] += np.linalg.norm(dx, axis=1)
+            moved = self._moved[:n] > self.relinearize_threshold
+            self._stale[:self.edge_count] |= moved[self.edges[:, 0]] | moved[self.edges[:, 1]]
+            self._moved[:n][moved] = 0
+            if converged:
+                break
+            A, B = self._jacobians(R, residuals, local)
+            g = self._gradient(A, B, residuals)
+
+        self._R[:n], self._t[:n] = R, t
+        self._optimum = cost if converged else None
+        return cost
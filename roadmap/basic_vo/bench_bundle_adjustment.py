@@ -0,0 +1,109 @@
+# Check of the local bundle adjustment on synthetic drives: a camera moving
+# forward through random landmarks, observed with pixel noise. Every new
+# keyframe gets a perturbed pose and the window is optimized, as the
+# pipeline does. Reports the rotation error of the relative poses before and
+# after the optimization, the time of an optimize() call and the scale of the
+# window (the baseline between its first two keyframes, which monocular BA
+# can't observe and must hold). Exits with an error when an optimize() call
+# changed the scale.
+#
+#   python -m roadmap.basic_vo.bench_bundle_adjustment --window 5 --frames 15
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from roadmap.basic_vo.bundle_adjustment import LocalBundleAdjuster
+
+K = np.array([[910.0, 0.0, 582.0], [0.0, 910.0, 437.0], [0.0, 0.0, 1.0]])
+
+
+def to_4x4(pose):
+    return np.vstack([pose, [0.0, 0.0, 0.0, 1.0]])
+
+
+def true_pose(i):
+    # world to camera pose of frame i: 1 unit forward per frame, slight turn
+    R = cv2.Rodrigues(np.array([0.01 * i, 0.02 * i, 0.0]))[0]
+    return np.hstack([R, (-R @ np.array([0.3 * i, 0.0, 1.0 * i]))[:, None]])
+
+
+def rotation_error(pose, reference):
+    # angle (degrees) between the rotations of two poses
+    return np.degrees(np.linalg.norm(cv2.Rodrigues(pose[:, :3] @ reference[:, :3].T)[0]))
+
+
+def relative_pose(first, second):
+    return (to_4x4(second) @ np.linalg.inv(to_4x4(first)))[:3]
+
+
+def run_drive(window, frames, n_points, noise, rng):
+    # returns per optimize() call the rotation error (degrees) of the new
+    # relative pose before and after it, its seconds and the ratio of the
+    # window scale after / before it
+    X = rng.uniform((-15, -5, 8), (15, 5, 60), (n_points, 3))
+    ids = np.arange(n_points)
+    ba = LocalBundleAdjuster(K, window=window)
+    results = []
+    for i in range(frames):
+        pose = true_pose(i)
+        Xc = X @ pose[:, :3].T + pose[:, 3]
+        points = Xc[:, :2] / Xc[:, 2:] @ np.diag(K[[0, 1], [0, 1]]) + K[:2, 2] + rng.normal(0, noise, (n_points, 2))
+        # only the landmarks in front of the camera and inside the image are observed
+        visible = (Xc[:, 2] > 1) & (points >= 0).all(axis=1) & (points < 2 * K[:2, 2]).all(axis=1)
+        points[~visible] = np.nan
+        if i > 0:
+            # the true motion, perturbed, on top of the last refined keyframe
+            motion = relative_pose(true_pose(i - 1), pose)
+            rvec = cv2.Rodrigues(motion[:, :3])[0] + rng.normal(0, 0.005, (3, 1))
+            motion = np.hstack([cv2.Rodrigues(rvec)[0], motion[:, 3:] + rng.normal(0, 0.05, (3, 1))])
+            pose = (to_4x4(motion) @ to_4x4(ba.keyframes[-1].pose))[:3]
+            seen = ~np.isnan(previous[:, 0])
+            ba.add_observations(ids[seen], previous[seen])
+        seen = ~np.isnan(points[:, 0])
+        ba.add_keyframe(pose, ids[seen], points[seen])
+        previous = points
+        if i == 0:
+            continue
+
+        truth = relative_pose(true_pose(i - 1), true_pose(i))
+        initial_error = rotation_error(ba.relative_pose(), truth)
+        initial_scale = window_scale(ba)
+        start = time.perf_counter()
+        ba.optimize()
+        seconds = time.perf_counter() - start
+        results.append((initial_error, rotation_error(ba.relative_pose(), truth), seconds,
+                        window_scale(ba) / initial_scale))
+    return results
+
+
+def window_scale(ba):
+    return np.linalg.norm(relative_pose(ba.keyframes[0].pose, ba.keyframes[1].pose)[:, 3])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local bundle adjustment check")
+    parser.add_argument("--window", type=int, default=5)
+    parser.add_argument("--points", type=int, default=400)
+    parser.add_argument("--noise", type=float, default=0.5, help="pixel noise of the observations")
+    parser.add_argument("--frames", type=int, default=15)
+    parser.add_argument("--trials", type=int, default=5, help="number of drives")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    results = np.array([result for _ in range(args.trials)
+                        for result in run_drive(args.window, args.frames, args.points, args.noise, rng)])
+    initial_error, error, seconds, scale = results.T
+    print(f"{args.trials} drives of {args.frames} frames, window of {args.window} keyframes, "
+          f"{args.points} landmarks, {args.noise} px noise")
+    print(f"relative rotation error: {initial_error.mean():.4f} -> {error.mean():.4f} deg")
+    print(f"optimize: {seconds.mean() * 1e3:.1f} ms")
+    print(f"scale after / before optimize: min {scale.min():.6f} max {scale.max():.6f}")
+    if not np.allclose(scale, 1.0, atol=1e-6):
+        sys.exit("optimize() didn't preserve the window scale")
+
+
+if __name__ == '__main__':
+    main()
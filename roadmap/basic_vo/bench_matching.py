@@ -0,0 +1,103 @@
+# Benchmark of the descriptor matcher backends against OpenCV's BFMatcher,
+# and of the guided matching (identity homography prior, the two frames are
+# consecutive) against the brute force matching it replaces.
+# Features come from two frames of a video when --video is given (resized by
+# --scale), random 256 bit descriptors at random points otherwise.
+#
+#   python -m roadmap.basic_vo.bench_matching --nfeatures 2000 --pairs 16
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from roadmap.basic_vo.matching import MATCHER_BACKENDS, GuidedMatcher
+from roadmap.basic_vo.ops import FeatureExtractor, FrameFeatures, match_descriptors
+
+
+def load_features(video_path, nfeatures, scale=1.0):
+    cap = cv2.VideoCapture(video_path)
+    extractor = FeatureExtractor(nfeatures=nfeatures)
+    features = []
+    for _ in range(2):
+        ret, frame = cap.read()
+        if not ret:
+            raise IOError(f"Couldn't read two frames from {video_path}")
+        if scale != 1.0:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale)
+        features.append(extractor.detectAndCompute(frame))
+    cap.release()
+    return features
+
+
+def random_features(nfeatures, width, height, rng):
+    # the second frame's points are the first ones moved by a few pixels
+    points = rng.uniform((0, 0), (width, height), (nfeatures, 2)).astype(np.float32)
+    moved = points + rng.normal(0, 2, points.shape).astype(np.float32)
+    return [FrameFeatures(p, rng.integers(0, 256, (nfeatures, 32), dtype=np.uint8)) for p in (points, moved)]
+
+
+def time_it(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bf_matcher_knn(des1, des2):
+    # the path the project used before the backends, knnMatch on DMatch lists
+    return cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(des1, des2, k=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Descriptor matcher backends benchmark")
+    parser.add_argument("--video", default=None, help="take the features from the first two frames")
+    parser.add_argument("--scale", type=float, default=1.0, help="resize the video frames by this factor")
+    parser.add_argument("--nfeatures", type=int, default=2000)
+    parser.add_argument("--pairs", type=int, default=8, help="frame pairs of the batched run")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.video is not None:
+        features1, features2 = load_features(args.video, args.nfeatures, args.scale)
+    else:
+        features1, features2 = random_features(args.nfeatures, 1164, 874, np.random.default_rng(0))
+    des1, des2 = features1.descriptors, features2.descriptors
+    print(f"{len(des1)} x {len(des2)} descriptors, {args.pairs} pairs in the batched run")
+
+    reference = bf_matcher_knn(des1, des2)
+    reference_distances = np.array([[m.distance, n.distance] for m, n in reference], np.int32)
+    seconds = time_it(lambda: bf_matcher_knn(des1, des2), args.repeat)
+    print(f"{'BFMatcher.knnMatch':>24}: {seconds * 1e3:8.2f} ms")
+
+    des1_list, des2_list = [des1] * args.pairs, [des2] * args.pairs
+    for name, backend_class in MATCHER_BACKENDS.items():
+        backend = backend_class()
+        distances, _ = backend.knn2(des1, des2)
+        # indices can differ on ties, the distances can't
+        agree = np.array_equal(distances, reference_distances)
+
+        seconds = time_it(lambda: backend.knn2(des1, des2), args.repeat)
+        batch_seconds = time_it(lambda: backend.knn2_batch(des1_list, des2_list), args.repeat)
+        print(f"{name + '.knn2':>24}: {seconds * 1e3:8.2f} ms  "
+              f"batch {batch_seconds / args.pairs * 1e3:8.2f} ms/pair  matches BFMatcher: {agree}")
+
+    # guided matching against the brute force matching with the ratio test
+    identity = np.eye(3)
+    for name in MATCHER_BACKENDS:
+        matcher = GuidedMatcher(backend=name)
+        brute_force_seconds = time_it(lambda: match_descriptors(des1, des2, matcher.ratio, matcher.backend),
+                                      args.repeat)
+        guided_seconds = time_it(lambda: matcher.match(features1, features2, identity), args.repeat)
+        guided_count = len(matcher.match(features1, features2, identity)[0])
+        brute_force_count = len(match_descriptors(des1, des2, matcher.ratio, matcher.backend)[0])
+        print(f"{'guided (' + name + ')':>24}: {guided_seconds * 1e3:8.2f} ms  "
+              f"brute force {brute_force_seconds * 1e3:8.2f} ms  "
+              f"speedup {brute_force_seconds / guided_seconds:5.1f}x  "
+              f"matches {guided_count} vs {brute_force_count}")
+
+
+if __name__ == '__main__':
+    main()
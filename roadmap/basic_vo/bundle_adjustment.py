@@ -0,0 +1,295 @@
+from collections import deque
+
+import cv2
+import numpy as np
+
+
+def skew(v):
+    # (...,3) vectors to the (...,3,3) cross product matrices [v]x
+    S = np.zeros(v.shape[:-1] + (3, 3))
+    S[..., 0, 1], S[..., 0, 2] = -v[..., 2], v[..., 1]
+    S[..., 1, 0], S[..., 1, 2] = v[..., 2], -v[..., 0]
+    S[..., 2, 0], S[..., 2, 1] = -v[..., 1], v[..., 0]
+    return S
+
+
+def huber_weights(errors, scale):
+    # IRLS weights of the Huber loss for the (M,) reprojection error norms
+    with np.errstate(divide='ignore'):
+        return np.where(errors <= scale, 1.0, scale / errors)
+
+
+def huber_cost(errors, scale):
+    return np.sum(np.where(errors <= scale, 0.5 * errors**2, scale * errors - 0.5 * scale**2))
+
+
+class _Keyframe:
+    def __init__(self, pose):
+        # world to camera x_c = R x_w + t
+        self.R = np.array(pose[:, :3], dtype=np.float64)
+        self.t = np.array(pose[:, 3], dtype=np.float64).ravel()
+        # track ids and their (M,2) pixel observations
+        self.ids = np.empty(0, np.int64)
+        self.points = np.empty((0, 2))
+
+    def add(self, ids, points):
+        # ids already observed in this frame are ignored
+        new = ~np.isin(ids, self.ids)
+        self.ids = np.concatenate([self.ids, ids[new]])
+        self.points = np.concatenate([self.points, np.asarray(points, np.float64).reshape(-1, 2)[new]])
+
+    @property
+    def pose(self):
+        return np.hstack([self.R, self.t[:, None]])
+
+
+class LocalBundleAdjuster:
+    # Sliding window bundle adjustment over the last `window` keyframes.
+    # Landmarks are identified by track ids, triangulated from the two
+    # keyframes that first observe them and refined together with the keyframe
+    # poses by Levenberg-Marquardt on the Huber robustified reprojection error.
+    # Monocular BA has 7 gauge freedoms: the oldest keyframe of the window is
+    # fixed and the distance between it and the second keyframe is held, so
+    # the scale of the window can't drift. The normal equations
+    # are reduced to the keyframe poses with the Schur complement on the
+    # landmarks, whose 3x3 blocks are inverted independently, so an iteration
+    # solves a 6 (window - 1) square system whatever the number of landmarks.
+    # Keyframes and landmarks leaving the window are dropped: the cost of
+    # optimize() is bounded by the window, not by the length of the drive.
+    def __init__(self, K, window=5, iterations=10, loss_scale=2.0, min_views=2, max_error=8.0):
+        self.K = np.asarray(K, dtype=np.float64)
+        self.window = window
+        self.iterations = iterations
+        # reprojection error (pixels) above which the Huber loss is linear
+        self.loss_scale = loss_scale
+        self.min_views = min_views
+        # landmarks reprojecting further than this (pixels) after the
+        # optimization are dropped, they are triangulated again if seen later
+        self.max_error = max_error
+        self.keyframes = deque()
+        # track id -> world point of the landmarks observed inside the window
+        self.landmarks = {}
+
+    def __len__(self):
+        return len(self.keyframes)
+
+    def reset(self):
+        # forgets the window, e.g. when the motion can't be estimated
+        self.keyframes.clear()
+        self.landmarks = {}
+
+    def add_observations(self, ids, points):
+        # more observations of the latest keyframe, e.g. the src side of a new frame pair
+        self.keyframes[-1].add(np.asarray(ids, np.int64), points)
+
+    def add_keyframe(self, pose, ids=(), points=()):
+        # pose is the (3,4) world to camera [R|t] of the new keyframe
+        keyframe = _Keyframe(np.asarray(pose, dtype=np.float64))
+        keyframe.add(np.asarray(ids, np.int64), points)
+        self.keyframes.append(keyframe)
+        if len(self.keyframes) > self.window:
+            self.keyframes.popleft()
+            alive = set(np.concatenate([k.ids for k in self.keyframes]).tolist())
+            self.landmarks = {i: X for i, X in self.landmarks.items() if i in alive}
+        if len(self.keyframes) >= 2:
+            self._triangulate(self.keyframes[-2], keyframe)
+
+    def _triangulate(self, first, second):
+        # new landmarks seen by both frames, kept when in front of both cameras
+        ids, idx1, idx2 = np.intersect1d(first.ids, second.ids, return_indices=True)
+        new = np.array([i not in self.landmarks for i in ids.tolist()], bool)
+        if not new.any():
+            return
+        ids, idx1, idx2 = ids[new], idx1[new], idx2[new]
+        P1, P2 = self.K @ first.pose, self.K @ second.pose
+        X = cv2.triangulatePoints(P1, P2, first.points[idx1].T, second.points[idx2].T)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            X = (X[:3] / X[3]).T
+        depth1 = X @ first.R[2] + first.t[2]
+        depth2 = X @ second.R[2] + second.t[2]
+        good = np.isfinite(X).all(axis=1) & (depth1 > 0) & (depth2 > 0)
+        self.landmarks.update(zip(ids[good].tolist(), X[good]))
+
+    def _problem(self):
+        # flat observation arrays of the landmarks seen by at least min_views
+        # keyframes, observations behind their camera are left out
+        frame_idx, landmark_ids, observed = [], [], []
+        for f, keyframe in enumerate(self.keyframes):
+            known = np.array([i in self.landmarks for i in keyframe.ids.tolist()], bool)
+            if known.any():
+                X = np.array([self.landmarks[i] for i in keyframe.ids[known].tolist()])
+                known[known] = X @ keyframe.R[2] + keyframe.t[2] > 0
+            frame_idx.append(np.full(known.sum(), f))
+            landmark_ids.append(keyframe.ids[known])
+            observed.append(keyframe.points[known])
+        frame_idx = np.concatenate(frame_idx)
+        landmark_ids = np.concatenate(landmark_ids)
+        observed = np.concatenate(observed)
+
+        _, point_idx, views = np.unique(landmark_ids, return_inverse=True, return_counts=True)
+        keep = views[point_idx] >= self.min_views
+        ids, point_idx = np.unique(landmark_ids[keep], return_inverse=True)
+        return ids, frame_idx[keep], point_idx, observed[keep]
+
+    def _linearize(self, R, t, X, frame_idx, point_idx, observed):
+        # residuals (M,2) and their jacobians wrt the pose update (M,2,6) and
+        # the landmark (M,2,3). The pose update (w, v) is the left perturbation
+        # x_c <- exp([w]x) x_c + v.
+        Xc = np.einsum('mij,mj->mi', R[frame_idx], X[point_idx]) + t[frame_idx]
+        inv_z = 1.0 / Xc[:, 2]
+        fx, fy = self.K[0, 0], self.K[1, 1]
+        residuals = np.column_stack([fx * Xc[:, 0] * inv_z + self.K[0, 2],
+                                     fy * Xc[:, 1] * inv_z + self.K[1, 2]]) - observed
+
+        # d(u, v) / d x_c
+        J_proj = np.zeros((len(Xc), 2, 3))
+        J_proj[:, 0, 0] = fx * inv_z
+        J_proj[:, 0, 2] = -fx * Xc[:, 0] * inv_z**2
+        J_proj[:, 1, 1] = fy * inv_z
+        J_proj[:, 1, 2] = -fy * Xc[:, 1] * inv_z**2
+
+        J_pose = np.concatenate([J_proj @ -skew(Xc), J_proj], axis=2)
+        J_point = J_proj @ R[frame_idx]
+        return residuals, J_pose, J_point
+
+    def _step(self, residuals, J_pose, J_point, errors, frame_idx, point_order, point_starts, damping,
+              scale_basis):
+        # damped Gauss-Newton step (pose updates (F-1,6), landmark updates (P,3))
+        # of the free keyframes, with the Schur complement on the landmarks.
+        # frame_idx is sorted, point_order sorts the observations by landmark
+        # and point_starts are the first sorted observation of every landmark.
+        # The update of the second keyframe is restricted to the span of the
+        # (6,k) scale_basis (see _scale_basis).
+        n_free, n_points = len(self.keyframes) - 1, len(point_starts)
+        w = huber_weights(errors, self.loss_scale)[:, None, None]
+        wJ_pose_t = np.swapaxes(w * J_pose, 1, 2)
+        wJ_point_t = np.swapaxes(w * J_point, 1, 2)
+
+        # blocks of the normal equations, summed per keyframe / landmark
+        frame_starts = np.searchsorted(frame_idx, np.arange(1, n_free + 1))
+        H_cc = np.add.reduceat(wJ_pose_t @ J_pose, frame_starts)
+        g_c = np.add.reduceat((wJ_pose_t @ residuals[:, :, None])[..., 0], frame_starts)
+        H_pp = np.add.reduceat((wJ_point_t @ J_point)[point_order], point_starts)
+        g_p = np.add.reduceat((wJ_point_t @ residuals[:, :, None])[point_order, :, 0], point_starts)
+        # one pose-landmark block per observation of a free keyframe
+        free = frame_idx > 0
+        point_idx = np.empty(len(point_order), np.int64)
+        point_idx[point_order] = np.repeat(np.arange(n_points), np.diff(np.append(point_starts, len(point_order))))
+        W = np.zeros((n_points, n_free, 6, 3))
+        W[point_idx[free], frame_idx[free] - 1] = wJ_pose_t[free] @ J_point[free]
+
+        # Marquardt damping of the diagonals
+        H_cc += damping * np.einsum('fii->fi', H_cc)[:, :, None] * np.eye(6)
+        H_pp += (damping * np.einsum('pii->pi', H_pp) + 1e-9)[:, :, None] * np.eye(3)
+        H_pp_inv = np.linalg.inv(H_pp)
+
+        # reduced camera system S dc = b, S = H_cc - sum_p W_p H_pp^-1 W_p^T
+        WH = (W @ H_pp_inv[:, None]).reshape(n_points, 6 * n_free, 3)
+        W = W.reshape(n_points, 6 * n_free, 3)
+        S = -WH.transpose(1, 0, 2).reshape(6 * n_free, -1) @ W.transpose(1, 0, 2).reshape(6 * n_free, -1).T
+        S = S.reshape(n_free, 6, n_free, 6)
+        S[np.arange(n_free), :, np.arange(n_free)] += H_cc
+        S = S.reshape(6 * n_free, 6 * n_free)
+        b = (WH @ g_p[:, :, None]).sum(axis=0)[:, 0] - g_c.ravel()
+        # dc = P y, P maps the reduced parameters y to the pose updates
+        k = scale_basis.shape[1]
+        P = np.zeros((6 * n_free, 6 * n_free - 6 + k))
+        P[:6, :k] = scale_basis
+        P[6:, k:] = np.eye(6 * n_free - 6)
+        dc = P @ np.linalg.solve(P.T @ S @ P, P.T @ b)
+        dp = -(H_pp_inv @ (g_p + (np.swapaxes(W, 1, 2) @ dc))[:, :, None])[..., 0]
+        return dc.reshape(n_free, 6), dp
+
+    @staticmethod
+    def _baseline(R, t):
+        # translation of the second keyframe relative to the first one, its
+        # norm is the scale of the window
+        return t[1] - R[1] @ R[0].T @ t[0]
+
+    @staticmethod
+    def _scale_basis(baseline):
+        # (6,5) basis of the second keyframe's pose updates (w, v) keeping the
+        # baseline norm to first order: the update moves the baseline to
+        # exp([w]x) baseline + v, so v must be orthogonal to the baseline
+        norm = np.linalg.norm(baseline)
+        if norm < 1e-12:
+            # no baseline, no scale to hold
+            return np.eye(6)
+        basis = np.zeros((6, 5))
+        basis[:3, :3] = np.eye(3)
+        basis[3:, 3:] = np.linalg.svd((baseline / norm)[None])[2][1:].T
+        return basis
+
+    def optimize(self):
+        # refines the window in place, returns the final robust cost or None
+        # when there is nothing to optimize
+        if len(self.keyframes) < 2 or not self.landmarks:
+            return None
+        ids, frame_idx, point_idx, observed = self._problem()
+        if len(ids) == 0 or (np.bincount(frame_idx, minlength=len(self.keyframes))[1:] == 0).any():
+            # a keyframe without landmarks can't be refined
+            return None
+
+        R = np.array([k.R for k in self.keyframes])
+        t = np.array([k.t for k in self.keyframes])
+        X = np.array([self.landmarks[i] for i in ids.tolist()])
+
+        residuals, J_pose, J_point = self._linearize(R, t, X, frame_idx, point_idx, observed)
+        errors = np.hypot(residuals[:, 0], residuals[:, 1])
+        cost = huber_cost(errors, self.loss_scale)
+        point_order = np.argsort(point_idx, kind="stable")
+        point_starts = np.searchsorted(point_idx[point_order], np.arange(len(ids)))
+        scale = np.linalg.norm(self._baseline(R, t))
+        damping = 1e-4
+        for _ in range(self.iterations):
+            try:
+                dc, dp = self._step(residuals, J_pose, J_point, errors, frame_idx, point_order, point_starts,
+                                    damping, self._scale_basis(self._baseline(R, t)))
+            except np.linalg.LinAlgError:
+                break
+
+            # the first keyframe is fixed, only the others are updated
+            R_new, t_new = R.copy(), t.copy()
+            for f in range(1, len(R)):
+                dR = cv2.Rodrigues(dc[f - 1, :3])[0]
+                R_new[f] = dR @ R[f]
+                t_new[f] = dR @ t[f] + dc[f - 1, 3:]
+            # the step keeps the scale to first order only, the baseline is
+            # brought back to its norm exactly
+            baseline = self._baseline(R_new, t_new)
+            norm = np.linalg.norm(baseline)
+            if scale > 1e-12 and norm > 1e-12:
+                t_new[1] += baseline * (scale / norm - 1)
+            X_new = X + dp
+            linearized = self._linearize(R_new, t_new, X_new, frame_idx, point_idx, observed)
+            new_errors = np.hypot(linearized[0][:, 0], linearized[0][:, 1])
+            new_cost = huber_cost(new_errors, self.loss_scale)
+
+            if not new_cost < cost:
+                # rejected, closer to gradient descent
+                damping *= 10
+                continue
+            converged = cost - new_cost < 1e-6 * cost
+            R, t, X = R_new, t_new, X_new
+            residuals, J_pose, J_point = linearized
+            errors, cost = new_errors, new_cost
+            damping = max(damping / 10, 1e-8)
+            if converged:
+                break
+
+        for keyframe, R_f, t_f in zip(self.keyframes, R, t):
+            keyframe.R, keyframe.t = R_f, t_f
+        self.landmarks.update(zip(ids.tolist(), X))
+
+        # worst reprojection error of every landmark
+        worst = np.zeros(len(ids))
+        np.maximum.at(worst, point_idx, errors)
+        for i in ids[worst > self.max_error].tolist():
+            del self.landmarks[i]
+        return cost
+
+    def relative_pose(self):
+        # [R|t] of the latest keyframe relative to the one before it
+        T1, T2 = np.eye(4), np.eye(4)
+        T1[:3], T2[:3] = self.keyframes[-2].pose, self.keyframes[-1].pose
+        return (T2 @ np.linalg.inv(T1))[:3]
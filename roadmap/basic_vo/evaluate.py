@@ -0,0 +1,179 @@
+# Headless batch evaluation of the basic VO pipeline.
+# Runs every <name>.hevc of the calib challenge folders with no GUI and no waitKey,
+# writes <name>.txt predictions (pitch yaw per line) plus a report.json with the
+# per video scores, and prints the aggregate throughput.
+# Videos are independent, with --workers they are spread over a process pool.
+#
+#   python -m roadmap.basic_vo.evaluate --workers 10
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from roadmap.basic_vo.matching import MATCHER_BACKENDS
+from roadmap.basic_vo.pipeline import run_sequence, FRONT_ENDS, ESTIMATORS
+
+DATA_DIRS = [
+    "roadmap/basic_vo/assets/calib_challenge-main/labeled/",
+    "roadmap/basic_vo/assets/calib_challenge-main/unlabeled/",
+]
+OUT_DIR = "roadmap/basic_vo/output/"
+
+
+def find_sequences(data_dir):
+    # (video_path, gt_path) pairs, gt_path is None when there is no <name>.txt label
+    sequences = []
+    for video_path in sorted(glob.glob(os.path.join(data_dir, "*.hevc"))):
+        gt_path = os.path.splitext(video_path)[0] + ".txt"
+        sequences.append((video_path, gt_path if os.path.exists(gt_path) else None))
+    return sequences
+
+
+def prediction_path(video_path, out_dir):
+    # labeled/0.hevc -> <out_dir>/labeled/0.txt, so equal names of different folders don't clash
+    folder = os.path.basename(os.path.dirname(os.path.abspath(video_path)))
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    return os.path.join(out_dir, folder, name + ".txt")
+
+
+def evaluate_sequence(video_path, gt_path, out_dir, vo_options=None, trajectory_format=None):
+    # every call owns its VideoCapture and VisualOdometry (extractor, matcher),
+    # nothing is shared between the sequences
+    gt = np.loadtxt(gt_path) if gt_path is not None else None
+    result = run_sequence(video_path, gt, vo_options=vo_options)
+
+    out_path = prediction_path(video_path, out_dir)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    np.savetxt(out_path, result.pop("predictions"))
+
+    trajectory = result.pop("trajectory")
+    frame_rate = result.pop("frame_rate")
+    if trajectory_format == "kitti":
+        trajectory.save_kitti(os.path.splitext(out_path)[0] + ".kitti", result["frames"])
+    elif trajectory_format == "tum":
+        trajectory.save_tum(os.path.splitext(out_path)[0] + ".tum", 1.0 / frame_rate if frame_rate > 0 else 1.0)
+    return result
+
+
+def init_worker(threads_per_worker):
+    # cap OpenCV's own thread pool so N workers don't oversubscribe the cores
+    cv2.setNumThreads(threads_per_worker)
+
+
+def _evaluate_sequence_job(args):
+    return evaluate_sequence(*args)
+
+
+def evaluate_sequences(sequences, out_dir, workers=1, threads_per_worker=None, vo_options=None,
+                       trajectory_format=None):
+    # results come back in the order of `sequences`
+    if workers <= 1:
+        return [evaluate_sequence(video_path, gt_path, out_dir, vo_options, trajectory_format)
+                for video_path, gt_path in sequences]
+
+    workers = min(workers, len(sequences))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    # spawn, a forked child can inherit OpenCV's thread pool in a locked state
+    context = multiprocessing.get_context("spawn")
+    jobs = [(video_path, gt_path, out_dir, vo_options, trajectory_format) for video_path, gt_path in sequences]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(threads_per_worker,)) as pool:
+        return list(pool.map(_evaluate_sequence_job, jobs))
+
+
+def summarize(results, wall_seconds):
+    frames = sum(r["frames"] for r in results)
+    # time spent inside the VO, summed over the workers
+    seconds = sum(r["seconds"] for r in results)
+    scores = [r["score"] for r in results if r["score"] is not None]
+    return {
+        "videos": len(results),
+        "frames": frames,
+        "seconds": seconds,
+        "wall_seconds": wall_seconds,
+        "fps": frames / wall_seconds if wall_seconds > 0 else 0.0,
+        "mean_score": float(np.mean(scores)) if scores else None,
+    }
+
+
+def write_report(results, summary, out_dir):
+    with open(os.path.join(out_dir, "report.json"), "w") as f:
+        json.dump({"summary": summary, "videos": results}, f, indent=2)
+
+
+def print_report(results, summary):
+    for r in results:
+        score = f"{r['score']:.2f}%" if r["score"] is not None else "-"
+        print(f"{r['video']}: {r['frames']} frames, {r['fps']:.1f} fps, error {score}")
+    print(f"{summary['videos']} videos, {summary['frames']} frames in {summary['wall_seconds']:.1f}s "
+          f"-> {summary['fps']:.1f} frames/sec")
+    if summary["mean_score"] is not None:
+        print(f"MEAN ERROR SCORE IS {summary['mean_score']:.2f}% (lower is better)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless evaluation of the basic VO pipeline")
+    parser.add_argument("--data-dir", nargs="+", default=DATA_DIRS,
+                        help="folders with the <name>.hevc / <name>.txt pairs")
+    parser.add_argument("--out-dir", default=OUT_DIR, help="where predictions and report.json are written")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes, one sequence per process")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="OpenCV threads of every worker, defaults to cores / workers")
+    parser.add_argument("--front-end", choices=FRONT_ENDS, default="orb",
+                        help="orb: detect and match every frame, klt: track features frame to frame, "
+                             "direct: photometric alignment of high gradient pixels")
+    parser.add_argument("--pyramid-levels", type=int, default=4, help="image pyramid levels of the direct front end")
+    parser.add_argument("--nfeatures", type=int, default=500, help="ORB features per frame")
+    parser.add_argument("--grid", default=None,
+                        help="ROWSxCOLS bucketed detection, e.g. 4x6, at most nfeatures/cells per cell")
+    parser.add_argument("--guided", action="store_true",
+                        help="match ORB within a window/epipolar band predicted from the last frame's motion")
+    parser.add_argument("--matcher", choices=tuple(MATCHER_BACKENDS), default="bf",
+                        help="brute force descriptor matcher backend")
+    parser.add_argument("--estimator", choices=ESTIMATORS, default="fundamental",
+                        help="8-point fundamental matrix RANSAC or 5-point essential matrix RANSAC")
+    parser.add_argument("--local-ba", action="store_true",
+                        help="refine the poses with a sliding window bundle adjustment")
+    parser.add_argument("--ba-window", type=int, default=5, help="frames in the bundle adjustment window")
+    parser.add_argument("--keyframes", action="store_true",
+                        help="estimate the motion on keyframes only, propagate it to the frames in between")
+    parser.add_argument("--min-parallax", type=float, default=5.0,
+                        help="median flow (pixels) since the last keyframe that makes a new one")
+    parser.add_argument("--max-interval", type=int, default=5, help="frames between two keyframes at most")
+    parser.add_argument("--smoothing", action="store_true", help="Kalman filter the pitch/yaw estimates")
+    parser.add_argument("--trajectory-format", choices=("kitti", "tum"), default=None,
+                        help="also write the camera trajectory of every sequence next to its predictions")
+    args = parser.parse_args()
+
+    extractor_options = {"nfeatures": args.nfeatures}
+    if args.grid is not None:
+        extractor_options["grid"] = tuple(int(n) for n in args.grid.lower().split("x"))
+    vo_options = {"front_end": args.front_end, "extractor_options": extractor_options, "guided": args.guided,
+                  "matcher_backend": args.matcher, "estimator": args.estimator,
+                  "local_ba": args.local_ba, "ba_options": {"window": args.ba_window},
+                  "keyframes": args.keyframes,
+                  "keyframe_options": {"min_parallax": args.min_parallax, "max_interval": args.max_interval},
+                  "smoothing": args.smoothing, "direct_options": {"levels": args.pyramid_levels}}
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    sequences = [seq for data_dir in args.data_dir for seq in find_sequences(data_dir)]
+    if not sequences:
+        parser.error(f"no .hevc videos found in {args.data_dir}")
+
+    start = time.perf_counter()
+    results = evaluate_sequences(sequences, args.out_dir, args.workers, args.threads_per_worker, vo_options,
+                                 args.trajectory_format)
+    summary = summarize(results, time.perf_counter() - start)
+    write_report(results, summary, args.out_dir)
+    print_report(results, summary)
+
+
+if __name__ == '__main__':
+    main()
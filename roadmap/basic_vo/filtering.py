@@ -0,0 +1,176 @@
+import numpy as np
+
+# Vector version of the BayesianFilter of roadmap/foundation/src/5_bayesian_filter.py:
+# a Kalman filter over [values, rates] with a constant velocity motion model,
+# used to smooth the per frame pitch/yaw estimates of the VO, and KalmanBank,
+# many independent filters updated together (feature tracks, pose streams).
+
+
+def constant_velocity_model(dim, process_noise, dt=1.0):
+    # transition F, measurement H and process noise Q of the state
+    # [p_1..p_d, v_1..v_d] with white noise acceleration, only p is measured
+    identity = np.eye(dim)
+    F = np.block([[identity, dt * identity], [np.zeros((dim, dim)), identity]])
+    H = np.hstack([identity, np.zeros((dim, dim))])
+    Q = np.kron(np.array([[dt**4 / 4, dt**3 / 2], [dt**3 / 2, dt**2]]), identity) * process_noise
+    return F, H, Q
+
+
+def inlier_measurement_variance(inliers, base_variance=1e-4, reference_inliers=100):
+    # measurement variance of a pose estimated from `inliers` correspondences,
+    # base_variance at reference_inliers and inversely proportional to the count
+    return base_variance * reference_inliers / max(inliers, 1)
+
+
+class ConstantVelocityKalmanFilter:
+    # state x = [p_1..p_d, v_1..v_d], p_k += v_k dt between frames and the
+    # rates are driven by white noise acceleration of variance process_noise.
+    # All the matrices are allocated once, predict/update are O(1) per frame.
+    def __init__(self, dim=2, process_noise=1e-7, initial_variance=1.0, dt=1.0):
+        self.dim = dim
+        self.x = np.zeros(2 * dim)
+        self.P = np.eye(2 * dim) * initial_variance
+        self.initialized = False
+
+        self.F, _, self.Q = constant_velocity_model(dim, process_noise, dt)
+        self.R = np.eye(dim)
+        self.x_buffer = np.zeros(2 * dim)
+
+    @property
+    def estimate(self):
+        return self.x[:self.dim]
+
+    def predict(self):
+        np.matmul(self.F, self.x, out=self.x_buffer)
+        self.x[:] = self.x_buffer
+        self.P[:] = self.F @ self.P @ self.F.T + self.Q
+        return self.estimate
+
+    def update(self, measurement, measurement_variance):
+        # measurement_variance is a scalar, a (d,) variance or a (d,d) covariance
+        z = np.asarray(measurement, dtype=np.float64)
+        if not self.initialized:
+            # the first measurement sets the values, the rates start at 0
+            self.x[:self.dim] = z
+            self.initialized = True
+
+        R = np.asarray(measurement_variance, dtype=np.float64)
+        if R.ndim < 2:
+            self.R[...] = 0
+            self.R[np.diag_indices(self.dim)] = R
+            R = self.R
+
+        # Compute Kalman Gain, H = [I 0] only picks the values out of the state
+        PHt = self.P[:, :self.dim]
+        S = self.P[:self.dim, :self.dim] + R
+        kalman_gain = np.linalg.solve(S, PHt.T).T
+
+        # Update estimate and uncertainty
+        self.x += kalman_gain @ (z - self.x[:self.dim])
+        self.P -= kalman_gain @ PHt.T
+        return self.estimate
+
+    def step(self, measurement=None, measurement_variance=None):
+        # one frame: predict, then update when there is a measurement
+        if self.initialized:
+            self.predict()
+        if measurement is not None:
+            self.update(measurement, measurement_variance)
+        return self.estimate
+
+
+class KalmanBank:
+    # N independent linear Kalman filters sharing the same model (F, H, Q),
+    # stored as stacked (N,d) states and (N,d,d) covariances. predict and
+    # update run on the whole bank (or a mask of it) with batched matmuls,
+    # there is no Python loop over the filters.
+    def __init__(self, F, H, Q, capacity=64):
+        self.F = np.asarray(F, dtype=np.float64)
+        self.H = np.asarray(H, dtype=np.float64)
+        self.Q = np.asarray(Q, dtype=np.float64)
+        d = len(self.F)
+        # preallocated storage, grown by doubling
+        self._x = np.zeros((capacity, d))
+        self._P = np.zeros((capacity, d, d))
+        self.count = 0
+
+    @classmethod
+    def constant_velocity(cls, dim=2, process_noise=1e-2, dt=1.0, capacity=64):
+        # a bank of constant velocity filters, e.g. dim=2 for image points
+        return cls(*constant_velocity_model(dim, process_noise, dt), capacity=capacity)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def x(self):
+        return self._x[:self.count]
+
+    @property
+    def P(self):
+        return self._P[:self.count]
+
+    @property
+    def estimates(self):
+        # (N,m) predicted measurements H x
+        return self.x @ self.H.T
+
+    def add(self, x, P):
+        # appends filters with initial states x (n,d) and covariances P (n,d,d)
+        # or (d,d), returns their indices
+        x = np.asarray(x, dtype=np.float64).reshape(-1, len(self.F))
+        n = len(x)
+        if self.count + n > len(self._x):
+            capacity = max(2 * len(self._x), self.count + n)
+            self._x = np.concatenate([self._x, np.zeros((capacity - len(self._x),) + self._x.shape[1:])])
+            self._P = np.concatenate([self._P, np.zeros((capacity - len(self._P),) + self._P.shape[1:])])
+        self._x[self.count:self.count + n] = x
+        self._P[self.count:self.count + n] = P
+        self.count += n
+        return np.arange(self.count - n, self.count)
+
+    def keep(self, mask):
+        # drops the filters where mask is False, the others keep their order
+        n = int(np.count_nonzero(mask))
+        self._x[:n] = self.x[mask]
+        self._P[:n] = self.P[mask]
+        self.count = n
+
+    def predict(self, mask=None):
+        # x <- F x, P <- F P F^T + Q of all the filters, or of the masked ones
+        if mask is None:
+            x, P = self.x, self.P
+            x[...] = x @ self.F.T
+            P[...] = self.F @ P @ self.F.T + self.Q
+        else:
+            self._x[:self.count][mask] = self.x[mask] @ self.F.T
+            self._P[:self.count][mask] = self.F @ self.P[mask] @ self.F.T + self.Q
+        return self.x
+
+    def update(self, measurements, R, mask=None):
+        # measurements (n,m) of the n filters selected by mask (all when None),
+        # R is the measurement covariance: scalar, (m,m), (n,) or (n,m,m)
+        index = slice(None) if mask is None else mask
+        x, P = self.x[index], self.P[index]
+        z = np.asarray(measurements, dtype=np.float64).reshape(len(x), -1)
+        m = len(self.H)
+        R = np.asarray(R, dtype=np.float64)
+        if R.ndim == 0:
+            R = np.eye(m) * R
+        elif R.ndim == 1:
+            R = R[:, None, None] * np.eye(m)
+
+        # innovation and its covariance S = H P H^T + R
+        y = z - x @ self.H.T
+        PHt = P @ self.H.T
+        S = np.einsum('ij,njk->nik', self.H, PHt) + R
+
+        # Kalman gains K = P H^T S^-1, one (d,m) matrix per filter
+        kalman_gain = np.swapaxes(np.linalg.solve(S, np.swapaxes(PHt, 1, 2)), 1, 2)
+        x += np.einsum('nij,nj->ni', kalman_gain, y)
+        P -= kalman_gain @ np.swapaxes(PHt, 1, 2)
+
+        if mask is not None:
+            self._x[:self.count][mask] = x
+            self._P[:self.count][mask] = P
+        return self.x
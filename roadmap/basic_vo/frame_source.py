@@ -0,0 +1,112 @@
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+
+class FrameSource:
+    # Decode-ahead video reader. A background thread decodes the video,
+    # converts to grayscale / downscales and puts ready uint8 frames in a
+    # bounded queue, so decoding overlaps with the VO work of the consumer.
+    #
+    # Frames are written into a fixed pool of preallocated buffers. A frame
+    # returned by read() stays valid until it is given back with recycle(),
+    # up to `held` frames can be kept by the consumer at the same time
+    # (the VO keeps the current and the previous frame).
+    def __init__(self, video_path, grayscale=True, scale=1.0, prefetch=4, held=2):
+        self.cap = cv2.VideoCapture(video_path)
+        if not self.cap.isOpened():
+            raise IOError(f"Couldn't open the video file {video_path}")
+
+        self.grayscale = grayscale
+        self.scale = scale
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.size = (int(round(width * scale)), int(round(height * scale)))
+        self.frame_shape = (self.size[1], self.size[0]) if grayscale else (self.size[1], self.size[0], 3)
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+
+        # decoded and intermediate images of the producer, reused for every frame
+        self._decoded = None
+        self._gray = np.empty((height, width), np.uint8) if grayscale and scale != 1.0 else None
+
+        self._free = queue.Queue()
+        for _ in range(prefetch + held):
+            self._free.put(np.empty(self.frame_shape, np.uint8))
+        self._ready = queue.Queue(maxsize=prefetch)
+
+        self._stopped = threading.Event()
+        # exception of the producer thread, raised by read() in the consumer
+        self._error = None
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _convert(self, frame, out):
+        if self.grayscale and self.scale != 1.0:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+            cv2.resize(self._gray, self.size, dst=out, interpolation=cv2.INTER_AREA)
+        elif self.grayscale:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=out)
+        elif self.scale != 1.0:
+            cv2.resize(frame, self.size, dst=out, interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(out, frame)
+
+    def _produce(self):
+        try:
+            while not self._stopped.is_set():
+                ret, self._decoded = self.cap.read(self._decoded)
+                if not ret:
+                    break
+                out = self._free.get()
+                if self._stopped.is_set():
+                    break
+                self._convert(self._decoded, out)
+                self._ready.put(out)
+        except Exception as error:
+            # e.g. a decoded frame of another size than the buffers
+            self._error = error
+        finally:
+            # end of the video, always queued so that read() never blocks forever
+            self._ready.put(None)
+
+    def read(self):
+        # next frame, None once the video is over. An error of the decoding
+        # thread is raised here, after the frames decoded before it
+        if self._stopped.is_set():
+            return None
+        frame = self._ready.get()
+        if frame is None and self._error is not None:
+            raise self._error
+        return frame
+
+    def recycle(self, frame):
+        # give a frame returned by read() back to the buffer pool
+        if frame is not None:
+            self._free.put(frame)
+
+    def __iter__(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+    def close(self):
+        self._stopped.set()
+        # unblock the producer if it waits for a free buffer or a queue slot
+        self._free.put(np.empty(self.frame_shape, np.uint8))
+        while self._thread.is_alive():
+            try:
+                self._ready.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self.cap.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
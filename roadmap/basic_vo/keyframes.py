@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+
+
+def median_parallax(src_pts, dst_pts):
+    # median image motion (pixels) of the correspondences
+    if len(src_pts) == 0:
+        return 0.0
+    flow = np.asarray(dst_pts, np.float64) - np.asarray(src_pts, np.float64)
+    return float(np.median(np.hypot(flow[:, 0], flow[:, 1])))
+
+
+def scale_rotation(R, fraction):
+    # rotation about the same axis by `fraction` of the angle of R, e.g.
+    # fraction=1/k is the per frame rotation of a motion spanning k frames
+    rvec = cv2.Rodrigues(np.ascontiguousarray(R, dtype=np.float64))[0]
+    return cv2.Rodrigues(rvec * fraction)[0]
+
+
+class KeyframeSelector:
+    # Decides which frames run the full pose estimation. The correspondences
+    # between the last keyframe and the current frame are cheap to get (KLT
+    # tracks or ORB matches), a new keyframe is selected once
+    #   - their median parallax reaches min_parallax pixels, the rotation
+    #     is poorly conditioned below that (slow or stationary car),
+    #   - fewer than min_tracked_ratio of the correspondences found on the
+    #     first frame after the keyframe are left,
+    #   - or max_interval frames have passed since the last keyframe.
+    def __init__(self, min_parallax=5.0, min_tracked_ratio=0.6, max_interval=5):
+        self.min_parallax = min_parallax
+        self.min_tracked_ratio = min_tracked_ratio
+        self.max_interval = max_interval
+        self.reset()
+
+    def reset(self):
+        # called when a new keyframe is set
+        self.interval = 0
+        self.initial_count = None
+        # statistics of the last select() call
+        self.parallax = 0.0
+        self.tracked_ratio = 1.0
+
+    def select(self, src_pts, dst_pts):
+        # src_pts are in the last keyframe, dst_pts in the current frame,
+        # returns True when the current frame should become a keyframe
+        self.interval += 1
+        if self.initial_count is None:
+            self.initial_count = max(len(src_pts), 1)
+        self.parallax = median_parallax(src_pts, dst_pts)
+        self.tracked_ratio = len(src_pts) / self.initial_count
+        return (self.interval >= self.max_interval or self.parallax >= self.min_parallax
+                or self.tracked_ratio < self.min_tracked_ratio)
@@ -0,0 +1,276 @@
+import abc
+
+import cv2
+import numpy as np
+
+from roadmap.basic_vo.ops import match_descriptors
+
+# number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+# and of every 16 bit value, used when np.bitwise_count isn't available (numpy < 2.0)
+POPCOUNT_TABLE_16 = POPCOUNT_TABLE[np.arange(1 << 16) & 0xFF] + POPCOUNT_TABLE[np.arange(1 << 16) >> 8]
+
+
+def popcount64(words):
+    # number of set bits of every uint64 of `words`
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    halves = words.view(np.uint16)
+    return POPCOUNT_TABLE_16[halves].reshape(words.shape + (4,)).sum(axis=-1, dtype=np.uint8)
+
+
+def as_words(des):
+    # (N,B) uint8 descriptors viewed as (N,ceil(B/8)) uint64 words, zero padded
+    des = np.ascontiguousarray(des, dtype=np.uint8)
+    if des.shape[1] % 8:
+        des = np.pad(des, ((0, 0), (0, 8 - des.shape[1] % 8)))
+    return des.view(np.uint64)
+
+
+def hamming_distance_pairs(des1, des2, idx1, idx2):
+    # Hamming distance of the descriptor pairs (des1[idx1[k]], des2[idx2[k]]),
+    # XOR + popcount of the uint64 words, summed word by word
+    xor = np.take(as_words(des1), idx1, axis=0)
+    xor ^= np.take(as_words(des2), idx2, axis=0)
+    counts = popcount64(xor)
+    distances = counts[:, 0].astype(np.int32)
+    for word in range(1, counts.shape[1]):
+        distances += counts[:, word]
+    return distances
+
+
+class SpatialGrid:
+    # Grid index over keypoints stored in CSR layout: the points are sorted by
+    # cell and cell_start[c]:cell_start[c+1] is the slice of the points of cell c
+    def __init__(self, points, cell_size):
+        self.cell_size = float(cell_size)
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        self.cols = int(cells[:, 0].max()) + 1 if len(points) else 1
+        self.rows = int(cells[:, 1].max()) + 1 if len(points) else 1
+        cell_ids = cells[:, 1] * self.cols + cells[:, 0]
+
+        self.order = np.argsort(cell_ids, kind="stable")
+        self.cell_start = np.searchsorted(cell_ids[self.order], np.arange(self.rows * self.cols + 1))
+
+    def candidates(self, query_points, radius_cells=1):
+        # all (query, point) pairs whose point lies in the (2r+1)x(2r+1) cells
+        # around the cell of the query, as two flat index arrays grouped by
+        # query (query indices in increasing order)
+        cells = np.floor(query_points / self.cell_size).astype(np.int64)
+        offsets = np.arange(-radius_cells, radius_cells + 1)
+        dx, dy = np.meshgrid(offsets, offsets)
+        cx = cells[:, 0:1] + dx.ravel()
+        cy = cells[:, 1:2] + dy.ravel()
+        query_idx = np.broadcast_to(np.arange(len(query_points))[:, None], cx.shape)
+
+        inside = (cx >= 0) & (cx < self.cols) & (cy >= 0) & (cy < self.rows)
+        cell_ids = (cy * self.cols + cx)[inside]
+        query_idx = query_idx[inside]
+        starts = self.cell_start[cell_ids]
+        counts = self.cell_start[cell_ids + 1] - starts
+
+        # expand every (query, cell) into one pair per point of the cell
+        total = int(counts.sum())
+        pair_query = np.repeat(query_idx, counts)
+        first_of_cell = np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.repeat(starts, counts) + (np.arange(total) - first_of_cell)
+        return pair_query, self.order[positions]
+
+
+def top2_per_query(query_idx, train_idx, distances, n_queries):
+    # best and second best candidate of every query, from flat candidate pairs
+    # grouped by query (as SpatialGrid.candidates returns them): a segmented
+    # minimum over every query's run of pairs, ties go to the first pair.
+    # returns the (n_queries,2) distances (inf when missing) and best train index
+    best_distances = np.full((n_queries, 2), np.inf)
+    best_train = np.full(n_queries, -1, np.int64)
+    if len(query_idx) == 0:
+        return best_distances, best_train
+    starts = np.flatnonzero(np.concatenate([[True], query_idx[1:] != query_idx[:-1]]))
+    counts = np.diff(np.append(starts, len(query_idx)))
+    queries = query_idx[starts]
+
+    best = np.minimum.reduceat(distances, starts)
+    # first pair of every run at the run's minimum
+    at_best = np.flatnonzero(distances == np.repeat(best, counts))
+    first = at_best[np.concatenate([[True], query_idx[at_best[1:]] != query_idx[at_best[:-1]]])]
+    others = distances.copy()
+    others[first] = np.iinfo(others.dtype).max
+    second = np.minimum.reduceat(others, starts)
+
+    best_distances[queries, 0] = best
+    best_train[queries] = train_idx[first]
+    has_second = counts > 1
+    best_distances[queries[has_second], 1] = second[has_second]
+    return best_distances, best_train
+
+
+class MatcherBackend(abc.ABC):
+    # Interface of the descriptor matchers: knn2 returns the (N,2) int32
+    # distances and (N,2) int32 indices in des2 of the two nearest neighbours
+    # of every des1 row, ordered best first. des2 needs at least 2 rows.
+    @abc.abstractmethod
+    def knn2(self, des1, des2):
+        pass
+
+    def knn2_batch(self, des1_list, des2_list):
+        # knn2 of many (des1, des2) pairs, e.g. one frame against many keyframes
+        return [self.knn2(des1, des2) for des1, des2 in zip(des1_list, des2_list)]
+
+
+class BFMatcherBackend(MatcherBackend):
+    # OpenCV brute force Hamming matcher
+    def knn2(self, des1, des2):
+        return cv2.batchDistance(des1, des2, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=2)
+
+
+class NumpyHammingMatcher(MatcherBackend):
+    # Pure NumPy brute force Hamming matcher. The 32 byte ORB descriptors are
+    # viewed as 4 uint64 words, distances are XOR + popcount of the words and
+    # the query rows are processed in blocks whose (rows, N2, 4) XOR
+    # intermediate stays around block_bytes, i.e. fits in L2 cache.
+    def __init__(self, block_bytes=512 * 1024):
+        self.block_bytes = block_bytes
+
+    as_words = staticmethod(as_words)
+
+    def _block_rows(self, n2, words, pairs=1):
+        return max(int(self.block_bytes // max(pairs * n2 * words * 8, 1)), 1)
+
+    def knn2(self, des1, des2):
+        words1 = self.as_words(des1)
+        words2 = self.as_words(des2)
+        n1, n2 = len(words1), len(words2)
+        distances = np.empty((n1, 2), np.int32)
+        indices = np.empty((n1, 2), np.int32)
+
+        block = self._block_rows(n2, words1.shape[1])
+        for start in range(0, n1, block):
+            stop = min(start + block, n1)
+            xor = words1[start:stop, None, :] ^ words2[None, :, :]
+            dist = popcount64(xor).sum(axis=2, dtype=np.int32)
+            self._top2(dist, distances[start:stop], indices[start:stop])
+        return distances, indices
+
+    @staticmethod
+    def _top2(dist, out_distances, out_indices):
+        # two smallest entries of every row, best first
+        top = np.argpartition(dist, 1, axis=-1)[..., :2]
+        top_dist = np.take_along_axis(dist, top, axis=-1)
+        swap = top_dist[..., 0] > top_dist[..., 1]
+        top[swap] = top[swap][..., ::-1]
+        top_dist[swap] = top_dist[swap][..., ::-1]
+        out_distances[...] = top_dist
+        out_indices[...] = top
+
+    def knn2_batch(self, des1_list, des2_list):
+        # All the pairs are padded to the same size and matched together as a
+        # (pairs, rows, N2) distance block, padded columns can never be the
+        # nearest neighbour.
+        if len(des1_list) == 0:
+            return []
+        n1 = max(len(d) for d in des1_list)
+        n2 = max(len(d) for d in des2_list)
+        words = self.as_words(des1_list[0][:1]).shape[1]
+        P = len(des1_list)
+        words1 = np.zeros((P, n1, words), np.uint64)
+        words2 = np.zeros((P, n2, words), np.uint64)
+        padded = np.ones((P, n2), bool)
+        for p, (des1, des2) in enumerate(zip(des1_list, des2_list)):
+            words1[p, :len(des1)] = self.as_words(des1)
+            words2[p, :len(des2)] = self.as_words(des2)
+            padded[p, :len(des2)] = False
+
+        distances = np.empty((P, n1, 2), np.int32)
+        indices = np.empty((P, n1, 2), np.int32)
+        block = self._block_rows(n2, words, P)
+        for start in range(0, n1, block):
+            stop = min(start + block, n1)
+            xor = words1[:, start:stop, None, :] ^ words2[:, None, :, :]
+            dist = popcount64(xor).sum(axis=3, dtype=np.int32)
+            # larger than any real distance
+            dist[np.broadcast_to(padded[:, None, :], dist.shape)] = 8 * 8 * words + 1
+            self._top2(dist, distances[:, start:stop], indices[:, start:stop])
+        return [(distances[p, :len(d)], indices[p, :len(d)]) for p, d in enumerate(des1_list)]
+
+
+MATCHER_BACKENDS = {
+    "bf": BFMatcherBackend,
+    "numpy": NumpyHammingMatcher,
+}
+
+
+def get_matcher_backend(backend):
+    # a MatcherBackend instance from its name in MATCHER_BACKENDS, instances are returned as is
+    if isinstance(backend, str):
+        if backend not in MATCHER_BACKENDS:
+            raise ValueError(f"Unknown matcher backend {backend}, expected one of {tuple(MATCHER_BACKENDS)}")
+        return MATCHER_BACKENDS[backend]()
+    return backend
+
+
+class GuidedMatcher:
+    # Matching restricted by a motion prior. With a homography prior (e.g. the
+    # infinite homography K R K^-1 of the previous rotation) every keypoint of
+    # the first frame is only compared to the keypoints of the second frame
+    # within `window` pixels of its predicted position, with a fundamental
+    # matrix prior only the ones within `epipolar_band` pixels of its epipolar
+    # line are kept. Without any prior it falls back to brute force matching.
+    def __init__(self, window=40.0, epipolar_band=3.0, ratio=0.75, max_distance=64, backend=None):
+        self.window = window
+        self.epipolar_band = epipolar_band
+        self.ratio = ratio
+        # a query with a single candidate can't be ratio tested, it is kept
+        # when its distance is below max_distance
+        self.max_distance = max_distance
+        # MatcherBackend of the brute force fallback
+        self.backend = get_matcher_backend(backend)
+
+    def match(self, features1, features2, homography=None, fundamental_mat=None):
+        # same contract as match_descriptors: query_idx, train_idx, distances arrays
+        if homography is None and fundamental_mat is None:
+            return match_descriptors(features1.descriptors, features2.descriptors, self.ratio, self.backend)
+        empty = np.empty(0, np.int32)
+        if len(features1) == 0 or len(features2) == 0:
+            return empty, empty, np.empty(0, np.float32)
+
+        pts1 = features1.points.astype(np.float64)
+        pts2 = features2.points.astype(np.float64)
+        predicted = pts1
+        if homography is not None:
+            projected = pts1 @ homography[:, :2].T + homography[:, 2]
+            predicted = projected[:, :2] / projected[:, 2:]
+
+        # cells of half the window, the 5x5 neighbourhood covers it with fewer
+        # extra candidates than 3x3 cells of the window size
+        grid = SpatialGrid(pts2, self.window / 2)
+        query_idx, train_idx = grid.candidates(predicted, radius_cells=2)
+        # per coordinate 1D arrays, the pair gathers are contiguous
+        x2, y2 = np.ascontiguousarray(pts2.T)
+        predicted_x, predicted_y = np.ascontiguousarray(predicted.T)
+        keep = (np.abs(x2[train_idx] - predicted_x[query_idx]) <= self.window) \
+            & (np.abs(y2[train_idx] - predicted_y[query_idx]) <= self.window)
+        query_idx, train_idx = query_idx[keep], train_idx[keep]
+
+        if fundamental_mat is not None:
+            # distance of x2 to the epipolar line l = F x1, lines scaled to a^2 + b^2 = 1
+            lines = pts1 @ fundamental_mat[:, :2].T + fundamental_mat[:, 2]
+            lines /= np.maximum(np.hypot(lines[:, 0], lines[:, 1]), 1e-12)[:, None]
+            a, b, c = np.ascontiguousarray(lines.T)
+            keep = np.abs(a[query_idx] * x2[train_idx] + b[query_idx] * y2[train_idx] + c[query_idx]) \
+                <= self.epipolar_band
+            query_idx, train_idx = query_idx[keep], train_idx[keep]
+        if len(query_idx) == 0:
+            return empty, empty, np.empty(0, np.float32)
+
+        distances = hamming_distance_pairs(features1.descriptors, features2.descriptors, query_idx, train_idx)
+        best_distances, best_train = top2_per_query(query_idx, train_idx, distances, len(pts1))
+
+        # ratio test, the same as the brute force path
+        has_second = np.isfinite(best_distances[:, 1])
+        good = np.where(has_second,
+                        best_distances[:, 0] < self.ratio * best_distances[:, 1],
+                        best_distances[:, 0] <= self.max_distance)
+        good &= best_train >= 0
+        query = np.flatnonzero(good).astype(np.int32)
+        return query, best_train[good].astype(np.int32), best_distances[good, 0].astype(np.float32)
@@ -1,10 +1,12 @@
 import cv2
 import numpy as np
 
-def orb_keypoints(images):
+def orb_keypoints(images, orb=None):
+    # a single ORB instance is shared by all the images
+    if orb is None:
+        orb = cv2.ORB_create()
     kp_des_list = []
     for image in images:
-        orb = cv2.ORB_create()
         # find the keypoints with ORB
         kp = orb.detect(image,None)
         # compute the descriptors with ORB
@@ -14,49 +16,170 @@ def orb_keypoints(images):
     return kp_des_list
 
 
+class FrameFeatures:
+    # features of a single frame, kept around so the next iteration of the
+    # VO loop can reuse them as the "previous" frame instead of running
+    # ORB on the same image again
+    def __init__(self, points, descriptors, scores=None, octaves=None):
+        # (N,2) float32 pixel coordinates of the keypoints
+        self.points = points
+        self.descriptors = descriptors
+        # (N,) float32 detector response and (N,) int32 pyramid level
+        self.scores = scores
+        self.octaves = octaves
 
-def feature_matching_with_ransac(images, kp_des_list):
-    im0 = images[0]
-    im1 = images[1]
+    @classmethod
+    def from_keypoints(cls, keypoints, descriptors):
+        n = len(keypoints)
+        points = keypoints_to_points(keypoints)
+        scores = np.fromiter((kp.response for kp in keypoints), np.float32, n)
+        octaves = np.fromiter((kp.octave for kp in keypoints), np.int32, n)
+        if descriptors is None:
+            # no keypoints (e.g. a black or textureless frame)
+            descriptors = np.empty((0, 32), np.uint8)
+        return cls(np.ascontiguousarray(points, np.float32), descriptors, scores, octaves)
 
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING)
-    kp1 = kp_des_list[0][0]
-    kp2 = kp_des_list[1][0]
+    def __len__(self):
+        return len(self.points)
 
-    des1 = kp_des_list[0][1]
-    des2 = kp_des_list[1][1]
+    def as_kp_des(self):
+        # same [kp, des] layout as a single entry of orb_keypoints, with the
+        # keypoints given as the (N,2) points array
+        return [self.points, self.descriptors]
 
-    matches = bf.knnMatch(des1, des2, k=2)
 
-    # For each pair of matches (m, n) obtained:
-    # m is the best match and n is the second-best match.
-    good_matches = []
-    for m, n in matches:
-        # The ratio test checks the quality of the matches.
-        # If the distance of the best match (m.distance) is significantly smaller than that of the second-best match (n.distance),
-        # then the match is considered to be "good".
-        # In this case, if m's distance is less than 75% of n's distance, it's added to the good_matches list.
-        if m.distance < 0.75 * n.distance:
-            good_matches.append(m)
+class FeatureExtractor:
+    # long lived ORB extractor, created once and reused for every frame
+    #
+    # With grid=(rows, cols) the frame is split in cells and at most
+    # max_per_cell features are kept per cell, so the features are spread over
+    # the whole image and the per frame count is bounded. A single ORB pass
+    # detects a larger pool of candidates (candidate_factor times the total
+    # budget), the strongest ones of every cell are kept and only those get a
+    # descriptor. Empty cells (sky, road) simply contribute nothing.
+    def __init__(self, nfeatures=500, scale_factor=1.2, nlevels=8, fast_threshold=20, edge_threshold=31,
+                 grid=None, max_per_cell=None, candidate_factor=4):
+        self.nfeatures = nfeatures
+        self.scale_factor = scale_factor
+        self.nlevels = nlevels
+        self.fast_threshold = fast_threshold
+        self.edge_threshold = edge_threshold
+        self.orb = self._create_orb(nfeatures)
 
-    # Extract the coordinates of matched keypoints
-    src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches])
-    dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches])
+        self.grid = grid
+        if grid is not None:
+            rows, cols = grid
+            if max_per_cell is None:
+                max_per_cell = max(nfeatures // (rows * cols), 1)
+            self.max_per_cell = max_per_cell
+            self.candidate_orb = self._create_orb(candidate_factor * max_per_cell * rows * cols)
+
+    def _create_orb(self, nfeatures):
+        return cv2.ORB_create(
+            nfeatures=nfeatures,
+            scaleFactor=self.scale_factor,
+            nlevels=self.nlevels,
+            edgeThreshold=self.edge_threshold,
+            fastThreshold=self.fast_threshold,
+        )
+
+    def _detect_grid(self, image):
+        keypoints = self.candidate_orb.detect(image, None)
+        if len(keypoints) == 0:
+            return FrameFeatures.from_keypoints(keypoints, None)
+        h, w = image.shape[:2]
+        rows, cols = self.grid
+        points = keypoints_to_points(keypoints)
+        cell_row = np.minimum((points[:, 1] * rows / h).astype(np.int64), rows - 1)
+        cell_col = np.minimum((points[:, 0] * cols / w).astype(np.int64), cols - 1)
+        cell = cell_row * cols + cell_col
+        response = np.fromiter((kp.response for kp in keypoints), np.float32, len(keypoints))
+
+        # strongest first within every cell, rank = position inside the cell
+        order = np.lexsort((-response, cell))
+        sorted_cell = cell[order]
+        first = np.searchsorted(sorted_cell, sorted_cell, side="left")
+        keep = order[np.arange(len(order)) - first < self.max_per_cell]
+        kp, des = self.orb.compute(image, [keypoints[i] for i in np.sort(keep)])
+        return FrameFeatures.from_keypoints(kp, des)
 
+    def detectAndCompute(self, image, mask=None):
+        if self.grid is not None and mask is None:
+            return self._detect_grid(image)
+        # detection and description in one pass over the scale pyramid
+        kp, des = self.orb.detectAndCompute(image, mask)
+        return FrameFeatures.from_keypoints(kp, des)
+
+
+def keypoints_to_points(kp):
+    # accepts a list of cv2.KeyPoint or an already converted (N,2) array
+    if isinstance(kp, np.ndarray):
+        return kp.reshape(-1, 2)
+    if len(kp) == 0:
+        # KeyPoint_convert returns () for an empty list
+        return np.empty((0, 2), np.float32)
+    return cv2.KeyPoint_convert(kp).reshape(-1, 2)
+
+
+def match_descriptors(des1, des2, ratio=0.75, backend=None):
+    # k=2 nearest neighbours of every des1 row in des2, returned as (N,2)
+    # distance and index arrays instead of lists of cv2.DMatch.
+    # backend is an optional MatcherBackend (roadmap/basic_vo/matching.py),
+    # OpenCV's brute force Hamming distance is used by default
+    if des1 is None or des2 is None or len(des1) == 0 or len(des2) < 2:
+        empty = np.empty(0, np.int32)
+        return empty, empty, np.empty(0, np.float32)
+    if backend is None:
+        distances, indices = cv2.batchDistance(des1, des2, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=2)
+    else:
+        distances, indices = backend.knn2(des1, des2)
+
+    # The ratio test checks the quality of the matches.
+    # The best match is kept only if its distance is less than `ratio` times
+    # the distance of the second-best match, for all the rows at once.
+    good = distances[:, 0] < ratio * distances[:, 1]
+    query_idx = np.flatnonzero(good).astype(np.int32)
+    train_idx = indices[good, 0].astype(np.int32)
+    return query_idx, train_idx, distances[good, 0].astype(np.float32)
+
+
+def estimate_fundamental_with_ransac(src_pts, dst_pts):
+    # the 8-point algorithm inside FM_RANSAC needs at least 8 correspondences
+    if len(src_pts) < 8:
+        raise ValueError("No matching was found !")
 
     # Use RANSAC to identify inliers
     # The fundamental matrix encapsulates the epipolar geometry between two views and is a fundamental concept in stereo vision and structure from motion.
     fundamental_mat, inliers = cv2.findFundamentalMat(src_pts, dst_pts, cv2.FM_RANSAC)
-    if inliers is None:
+    if inliers is None or fundamental_mat is None:
         raise ValueError("No matching was found !")
+    # several solutions can be stacked by the 7-point solver, keep the first one
+    return fundamental_mat[:3], inliers.ravel().astype(bool)
 
-    # Filter matches using the inliers
-    ransac_matches = [good_matches[i] for i, val in enumerate(inliers) if val == 1]
 
-    # Extract the coordinates of matched keypoints using RANSAC matches
-    src_pts_ransac = np.float32([kp1[m.queryIdx].pt for m in ransac_matches])
-    dst_pts_ransac = np.float32([kp2[m.trainIdx].pt for m in ransac_matches])
+def feature_matching_with_ransac(images, kp_des_list, ratio=0.75):
+    kp1 = kp_des_list[0][0]
+    kp2 = kp_des_list[1][0]
+    pts1 = keypoints_to_points(kp1)
+    pts2 = keypoints_to_points(kp2)
+
+    des1 = kp_des_list[0][1]
+    des2 = kp_des_list[1][1]
+
+    query_idx, train_idx, _ = match_descriptors(des1, des2, ratio)
+
+    # Extract the coordinates of matched keypoints
+    src_pts = np.float32(pts1[query_idx])
+    dst_pts = np.float32(pts2[train_idx])
+
+    fundamental_mat, inlier_mask = estimate_fundamental_with_ransac(src_pts, dst_pts)
+
+    # Filter matches using the inliers mask, matches are (M,2) [query, train] index pairs
+    ransac_matches = np.stack([query_idx[inlier_mask], train_idx[inlier_mask]], axis=1)
 
+    # Coordinates of matched keypoints using RANSAC matches
+    src_pts_ransac = src_pts[inlier_mask]
+    dst_pts_ransac = dst_pts[inlier_mask]
 
     return fundamental_mat, kp1, kp2, ransac_matches, src_pts_ransac, dst_pts_ransac
 
@@ -80,3 +203,54 @@ def get_euler_angles(rotation_matrix):
 def get_mse(gt, test):
   test = np.nan_to_num(test)
   return np.mean(np.nanmean((gt - test)**2, axis=0))
+
+
+class ErrorAccumulator:
+    # Streaming version of the calib challenge score. Running sums of the
+    # squared error and of the all-zeros baseline error are kept per column,
+    # so every update is O(1) and gives the same score as
+    # 100 * get_mse(gt[:n], pred[:n]) / get_mse(gt[:n], zeros)
+    def __init__(self, gt, capacity=None):
+        self.gt = np.asarray(gt, dtype=np.float64).reshape(-1, 2)
+        if capacity is None:
+            capacity = len(self.gt)
+        # preallocated, grown by doubling if more frames than expected arrive
+        self.predictions = np.zeros((max(capacity, 1), 2))
+        self.count = 0
+
+        self.squared_error = np.zeros(2)
+        self.zero_squared_error = np.zeros(2)
+        # number of non NaN ground truth values seen so far, per column
+        self.valid_count = np.zeros(2, dtype=np.int64)
+
+    def update(self, prediction):
+        if self.count == len(self.predictions):
+            self.predictions = np.concatenate([self.predictions, np.zeros_like(self.predictions)])
+        # same NaN handling as get_mse, NaN predictions count as 0
+        prediction = np.nan_to_num(np.asarray(prediction, dtype=np.float64))
+        self.predictions[self.count] = prediction
+
+        if self.count < len(self.gt):
+            gt = self.gt[self.count]
+            # NaN ground truth is skipped, like the nanmean in get_mse
+            valid = ~np.isnan(gt)
+            self.squared_error[valid] += (gt[valid] - prediction[valid])**2
+            self.zero_squared_error[valid] += gt[valid]**2
+            self.valid_count += valid
+        self.count += 1
+
+    def get_predictions(self):
+        return self.predictions[:self.count]
+
+    def mse(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.mean(self.squared_error / self.valid_count)
+
+    def zero_mse(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.mean(self.zero_squared_error / self.valid_count)
+
+    def score(self):
+        # percent error vs all zeros, lower is better
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 100 * self.mse() / self.zero_mse()
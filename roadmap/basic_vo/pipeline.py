@@ -0,0 +1,364 @@
+import time
+
+import cv2
+import numpy as np
+
+from roadmap.adv_vo.direct_vo import DirectOdometry
+from roadmap.epipolar_geo.rectification_stereo import estimate_essential_matrix, decompose_essential_matrix_poses, \
+                select_pose_by_cheirality
+from roadmap.epipolar_geo.robust_estimation import estimate_essential_ransac
+from roadmap.basic_vo.bundle_adjustment import LocalBundleAdjuster
+from roadmap.basic_vo.filtering import ConstantVelocityKalmanFilter, inlier_measurement_variance
+from roadmap.basic_vo.frame_source import FrameSource
+from roadmap.basic_vo.keyframes import KeyframeSelector, scale_rotation
+from roadmap.basic_vo.matching import GuidedMatcher, get_matcher_backend
+from roadmap.basic_vo.ops import FeatureExtractor, match_descriptors, \
+                            estimate_fundamental_with_ransac, get_euler_angles, ErrorAccumulator
+from roadmap.basic_vo.tracking import KLTTracker
+from roadmap.basic_vo.trajectory import Trajectory
+
+
+INTRINSIC_MATRIX = np.array([
+                                [910,      0, 874/2.0],
+                                [0,      910, 1164/2.0],
+                                [0,        0,     1]
+                            ])
+
+
+def scale_intrinsic_matrix(K, scale):
+    # intrinsics of the same camera after resizing the image by `scale`
+    K = np.array(K, dtype=np.float64)
+    K[:2] *= scale
+    return K
+
+
+FRONT_ENDS = ("orb", "klt", "direct")
+ESTIMATORS = ("fundamental", "essential")
+
+
+class VisualOdometry:
+    # two view VO, one call of process_frame per video frame
+    # front_end "orb" detects and matches ORB on every frame, "klt" tracks the
+    # features of the previous frame with pyramidal Lucas-Kanade, "direct"
+    # aligns the frame to the previous one photometrically (DirectOdometry,
+    # direct_options are its arguments), without correspondences there is
+    # no RANSAC, keyframe selection or bundle adjustment in that mode
+    # extractor_options are the FeatureExtractor arguments, e.g. {"grid": (4, 6)}
+    # guided=True matches ORB only around the position predicted by the last
+    # frame's rotation and along the last epipolar geometry (constant motion)
+    # matcher_backend is the brute force MatcherBackend or its name ("bf", "numpy")
+    # estimator "fundamental" runs OpenCV's 8-point RANSAC on pixels and derives
+    # E = K^T F K, "essential" runs the 5-point RANSAC on calibrated points
+    # (PROSAC ordered by the match distances of the ORB front end)
+    # local_ba=True refines every pose in a sliding window bundle adjustment
+    # over the last frames, ba_options are the LocalBundleAdjuster arguments
+    # keyframes=True only estimates the motion on the frames picked by a
+    # KeyframeSelector (keyframe_options are its arguments), the frames in
+    # between keep the per frame motion of the last keyframe pair
+    # smoothing=True filters the pitch/yaw with a constant velocity Kalman
+    # filter (filter_options are its arguments), the measurement variance
+    # follows the inlier count and frames without an estimate only predict
+    def __init__(self, intrinsic_matrix=INTRINSIC_MATRIX, extractor=None, front_end="orb", tracker=None,
+                 extractor_options=None, guided=False, matcher=None, min_guided_matches=30,
+                 matcher_backend=None, estimator="fundamental", ransac_options=None, local_ba=False,
+                 ba_options=None, keyframes=False, keyframe_options=None, smoothing=False,
+                 filter_options=None, measurement_variance=1e-4, direct_options=None):
+        if front_end not in FRONT_ENDS:
+            raise ValueError(f"Unknown front end {front_end}, expected one of {FRONT_ENDS}")
+        if estimator not in ESTIMATORS:
+            raise ValueError(f"Unknown estimator {estimator}, expected one of {ESTIMATORS}")
+        self.K = intrinsic_matrix
+        self.front_end = front_end
+        self.estimator = estimator
+        # estimate_essential_ransac arguments, e.g. {"threshold": 1.0, "lo_iterations": 0}
+        self.ransac_options = ransac_options or {}
+        # inlier ratio, inlier count and RANSAC iterations of the last frame pair
+        self.inlier_ratio = 0.0
+        self.inlier_count = 0
+        self.ransac_iterations = 0
+        # created once, reused for every frame
+        self.extractor = extractor if extractor is not None else FeatureExtractor(**(extractor_options or {}))
+        self.tracker = tracker if tracker is not None else KLTTracker()
+        self.direct_odometry = DirectOdometry(self.K, **(direct_options or {})) if front_end == "direct" else None
+        self.guided = guided
+        self.matcher_backend = get_matcher_backend(matcher_backend)
+        self.matcher = matcher if matcher is not None else GuidedMatcher(backend=self.matcher_backend)
+        # below this many guided matches the frame is matched by brute force
+        self.min_guided_matches = min_guided_matches
+        self.K_inv = np.linalg.inv(self.K)
+
+        self.bundle_adjuster = LocalBundleAdjuster(self.K, **(ba_options or {})) if local_ba else None
+        self.keyframe_selector = KeyframeSelector(**(keyframe_options or {})) if keyframes else None
+        self.pose_filter = ConstantVelocityKalmanFilter(**(filter_options or {})) if smoothing else None
+        # pitch/yaw variance of an estimate from 100 inliers
+        self.measurement_variance = measurement_variance
+
+        # The motion is estimated between the reference frame (the last
+        # keyframe, the previous frame without keyframe selection) and the
+        # current frame. ORB: features of both frames, computed once per frame
+        self.prev_features = None
+        self.features = None
+        # track ids of the ORB features of the current and the reference frame,
+        # a matched inlier keeps the id of the feature it was matched to
+        self.feature_ids = np.empty(0, np.int64)
+        self.prev_feature_ids = np.empty(0, np.int64)
+        self.next_feature_id = 0
+        self.last_match = None
+        # KLT: track ids and positions of the tracks in the reference frame
+        self.reference_ids = np.empty(0, np.int64)
+        self.reference_points = np.empty((0, 2), np.float32)
+        self.last_tracked = None
+        # frames since the reference frame
+        self.interval = 0
+        # index of the current frame and the composed poses of the estimated
+        # frames, timestamped with their frame index
+        self.frame_index = -1
+        self.trajectory = Trajectory()
+
+        # per frame motion of the last keyframe pair, the prior of the guided
+        # matching, and the epipolar geometry over `prev_interval` frames
+        self.prev_rotation = None
+        self.prev_fundamental = None
+        self.prev_interval = 1
+        self.pitch, self.yaw = 0.0, 0.0
+
+        # reused by every decomposition of the essential matrix
+        self.possible_poses = np.empty((4, 3, 4))
+
+    def estimate_geometry(self, src_pts, dst_pts, match_distances=None):
+        # returns the fundamental matrix, the essential matrix and the (N,) inlier mask
+        if self.estimator == "essential":
+            essential_mat, inlier_mask, self.inlier_ratio, self.ransac_iterations = estimate_essential_ransac(
+                src_pts, dst_pts, self.K, match_distances=match_distances, **self.ransac_options)
+            # F = K^-T E K^-1, the epipolar prior of the guided matching is in pixels
+            fundamental_mat = self.K_inv.T @ essential_mat @ self.K_inv
+        else:
+            fundamental_mat, inlier_mask = estimate_fundamental_with_ransac(src_pts, dst_pts)
+            essential_mat = estimate_essential_matrix(fundamental_mat, self.K, self.K)
+            self.inlier_ratio = inlier_mask.mean()
+        self.inlier_count = int(np.count_nonzero(inlier_mask))
+        return fundamental_mat, essential_mat, inlier_mask
+
+    def estimate_pose(self, src_pts, dst_pts, essential_mat):
+        # get all four possible (R, t) hypotheses as a (4,3,4) array
+        decompose_essential_matrix_poses(essential_mat, out=self.possible_poses)
+
+        # cheirality verification, the hypothesis with most points in front of both cameras
+        R, t, in_front, _ = select_pose_by_cheirality(self.K, self.possible_poses[:, :, :3],
+                                                      self.possible_poses[:, :, 3:], src_pts, dst_pts)
+        if not in_front.any():
+            return None, None
+        return R, t
+
+    def match_orb(self, frame):
+        # each frame is detected exactly once, the reference frame's features are reused
+        features = self.extractor.detectAndCompute(frame)
+        self.features = features
+        self.feature_ids = np.arange(self.next_feature_id, self.next_feature_id + len(features))
+        self.next_feature_id += len(features)
+        prev_features = self.prev_features
+        if prev_features is None:
+            return None
+
+        query_idx = None
+        if self.guided and self.prev_rotation is not None:
+            # infinite homography of the rotation since the reference frame
+            # (constant motion) predicts where the points move
+            rotation = scale_rotation(self.prev_rotation, self.interval + 1)
+            homography = self.K @ rotation @ self.K_inv
+            fundamental_mat = self.prev_fundamental if self.prev_interval == self.interval + 1 else None
+            query_idx, train_idx, distances = self.matcher.match(prev_features, features, homography,
+                                                                 fundamental_mat)
+            if len(query_idx) < self.min_guided_matches:
+                query_idx = None
+        if query_idx is None:
+            query_idx, train_idx, distances = match_descriptors(prev_features.descriptors, features.descriptors,
+                                                                backend=self.matcher_backend)
+
+        self.last_match = query_idx, train_idx
+        return (prev_features.points[query_idx], features.points[train_idx], distances,
+                self.prev_feature_ids[query_idx])
+
+    def track_klt(self, frame):
+        first_frame = self.tracker.prev_image is None
+        _, dst_pts = self.tracker.track(frame)
+        if first_frame:
+            return None
+        # the tracks already in the reference frame, from their position there
+        ids = self.tracker.ids[:len(dst_pts)]
+        _, in_reference, tracked = np.intersect1d(self.reference_ids, ids, assume_unique=True, return_indices=True)
+        self.last_tracked = tracked
+        # tracks have no match quality, no PROSAC ordering
+        return self.reference_points[in_reference], dst_pts[tracked], None, ids[tracked]
+
+    def discard_outliers(self, inlier_mask):
+        # inlier_mask is over the correspondences of the last front end call
+        if self.front_end == "klt":
+            # outliers are not tracked any further
+            keep = np.ones(len(self.tracker.points), bool)
+            keep[self.last_tracked] = inlier_mask
+            self.tracker.discard(keep)
+        else:
+            # matched inliers keep their track id
+            query_idx, train_idx = self.last_match
+            self.feature_ids[train_idx[inlier_mask]] = self.prev_feature_ids[query_idx[inlier_mask]]
+
+    def set_reference(self):
+        # the current frame becomes the reference of the next ones
+        if self.front_end == "klt":
+            self.reference_ids = self.tracker.ids.copy()
+            self.reference_points = self.tracker.points.copy()
+        else:
+            self.prev_features, self.prev_feature_ids = self.features, self.feature_ids
+        self.interval = 0
+        if self.keyframe_selector is not None:
+            self.keyframe_selector.reset()
+
+    def refine_pose(self, src_pts, dst_pts, ids, R, t):
+        # Adds the frame to the bundle adjustment window, optimizes the window
+        # and returns the refined motion of the frame pair. The new pose is
+        # chained from the last refined one, the translation (unit length from
+        # the essential matrix) takes the scale of the last refined motion.
+        ba = self.bundle_adjuster
+        if len(ba) == 0:
+            ba.add_keyframe(np.eye(3, 4))
+        scale = np.linalg.norm(ba.relative_pose()[:, 3]) if len(ba) >= 2 else 1.0
+        motion = np.vstack([np.hstack([R, scale * t.reshape(3, 1)]), [0, 0, 0, 1]])
+        pose = motion[:3] @ np.vstack([ba.keyframes[-1].pose, [0, 0, 0, 1]])
+
+        ba.add_observations(ids, src_pts)
+        ba.add_keyframe(pose, ids, dst_pts)
+        ba.optimize()
+        relative = ba.relative_pose()
+        return relative[:, :3], relative[:, 3:]
+
+    def process_frame(self, frame):
+        # returns the (pitch, yaw) estimate, None for the very first frame
+        self.frame_index += 1
+        if self.front_end == "direct":
+            return self.process_direct(frame)
+        try:
+            if self.front_end == "klt":
+                correspondences = self.track_klt(frame)
+            else:
+                correspondences = self.match_orb(frame)
+            if correspondences is None:
+                self.set_reference()
+                self.trajectory.append(np.eye(4), self.frame_index)
+                return None
+            src_pts, dst_pts, match_distances, ids = correspondences
+            self.interval += 1
+            if self.keyframe_selector is not None and not self.keyframe_selector.select(src_pts, dst_pts):
+                # not a keyframe, the motion is propagated
+                return self.smooth(None)
+
+            fundamental_mat, essential_mat, inlier_mask = self.estimate_geometry(src_pts, dst_pts, match_distances)
+            self.discard_outliers(inlier_mask)
+            src_pts, dst_pts, ids = src_pts[inlier_mask], dst_pts[inlier_mask], ids[inlier_mask]
+            R, t = self.estimate_pose(src_pts, dst_pts, essential_mat)
+            if R is not None and self.bundle_adjuster is not None:
+                R, t = self.refine_pose(src_pts, dst_pts, ids, R, t)
+        except (ValueError, cv2.error):
+            # not enough matches (e.g. a black frame) or a degenerate estimation
+            # (OpenCV errors, LinAlgError is a ValueError), keep the last estimate
+            R = None
+            fundamental_mat = None
+
+        if R is None and self.bundle_adjuster is not None:
+            # the chain of poses is broken, start a new window
+            self.bundle_adjuster.reset()
+        if R is not None:
+            # the translation has unit length, unless refined by the bundle adjustment
+            self.trajectory.append_relative(R, t, self.frame_index)
+            # the motion spans `interval` frames, the estimate is per frame
+            R = scale_rotation(R, 1.0 / self.interval) if self.interval > 1 else R
+            self.pitch, self.yaw = get_euler_angles(R)
+        self.prev_rotation = R
+        self.prev_fundamental = fundamental_mat if R is not None else None
+        self.prev_interval = self.interval
+        self.set_reference()
+        return self.smooth(R)
+
+    def process_direct(self, frame):
+        # the motion since the previous frame from the photometric alignment
+        motion = self.direct_odometry.track(frame)
+        if motion is None:
+            self.trajectory.append(np.eye(4), self.frame_index)
+            return None
+        R, t = motion
+        self.inlier_count = self.direct_odometry.inlier_count
+        self.inlier_ratio = self.direct_odometry.inlier_ratio
+        if R is not None:
+            self.trajectory.append_relative(R, t, self.frame_index)
+            self.pitch, self.yaw = get_euler_angles(R)
+        self.prev_rotation = R
+        return self.smooth(R)
+
+    def smooth(self, R):
+        # the returned (pitch, yaw), R is None when the frame has no new estimate
+        if self.pose_filter is None:
+            return self.pitch, self.yaw
+        if R is None:
+            pitch, yaw = self.pose_filter.step()
+        else:
+            variance = inlier_measurement_variance(self.inlier_count, self.measurement_variance)
+            pitch, yaw = self.pose_filter.step((self.pitch, self.yaw), variance)
+        return pitch, yaw
+
+
+def run_sequence(video_path, gt=None, vo=None, on_frame=None, grayscale=True, scale=1.0, prefetch=4,
+                 vo_options=None):
+    # Runs the VO over a whole video without any GUI.
+    # gt is the optional (N,2) pitch/yaw ground truth, on_frame(frame, pitch_yaw, score)
+    # is called after every estimate and can return False to stop early.
+    # Frames are decoded ahead on a background thread, converted to grayscale
+    # and resized by `scale` (the intrinsics are scaled to match).
+    # vo_options are passed to VisualOdometry when vo isn't given, e.g. {"front_end": "klt"}
+    source = FrameSource(video_path, grayscale=grayscale, scale=scale, prefetch=prefetch)
+
+    if vo is None:
+        vo = VisualOdometry(scale_intrinsic_matrix(INTRINSIC_MATRIX, scale), **(vo_options or {}))
+    accumulator = ErrorAccumulator(gt if gt is not None else np.full((max(source.frame_count, 1), 2), np.nan))
+
+    frames = 0
+    prev_frame = None
+    # frames before the first estimate (frame 0), they get the first estimate
+    # so that row i of the predictions is frame i
+    pending = 0
+    start = time.perf_counter()
+    try:
+        for frame in source:
+            frames += 1
+            pitch_yaw = vo.process_frame(frame)
+            # only the current and the previous frame are held, older buffers go back to the pool
+            source.recycle(prev_frame)
+            prev_frame = frame
+            if pitch_yaw is None:
+                pending += 1
+                continue
+            for _ in range(pending + 1):
+                accumulator.update(pitch_yaw)
+            pending = 0
+
+            if on_frame is not None:
+                score = accumulator.score() if gt is not None else None
+                if on_frame(frame, pitch_yaw, score) is False:
+                    break
+    finally:
+        source.close()
+    seconds = time.perf_counter() - start
+    for _ in range(pending):
+        # no estimate at all (e.g. a single frame video)
+        accumulator.update((np.nan, np.nan))
+
+    return {
+        "video": str(video_path),
+        "predictions": accumulator.get_predictions(),
+        "score": float(accumulator.score()) if gt is not None else None,
+        "frames": frames,
+        "seconds": seconds,
+        "fps": frames / seconds if seconds > 0 else 0.0,
+        # timestamps are frame indices, frame_rate converts them to seconds
+        "trajectory": vo.trajectory,
+        "frame_rate": source.fps,
+    }
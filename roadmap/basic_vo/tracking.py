@@ -0,0 +1,81 @@
+import cv2
+import numpy as np
+
+
+class KLTTracker:
+    # Frame to frame tracking front-end. Features are carried forward with
+    # pyramidal Lucas-Kanade and only re-detected when too few of them survive,
+    # instead of detecting and matching ORB on every frame.
+    def __init__(self, max_corners=1000, min_tracked=300, quality_level=0.01, min_distance=10,
+                 win_size=(21, 21), max_level=3):
+        self.max_corners = max_corners
+        # re-detect once fewer features than this are tracked
+        self.min_tracked = min_tracked
+        self.feature_params = dict(maxCorners=max_corners, qualityLevel=quality_level,
+                                   minDistance=min_distance, blockSize=7)
+        self.lk_params = dict(winSize=win_size, maxLevel=max_level,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+        self.min_distance = min_distance
+
+        # previous grayscale frame and its (N,2) float32 features
+        self.prev_image = None
+        self.points = np.empty((0, 2), np.float32)
+        # a track id per feature, kept while the feature is tracked
+        self.ids = np.empty(0, np.int64)
+        self.next_id = 0
+
+    def _detect(self, image, existing):
+        corners = cv2.goodFeaturesToTrack(image, mask=None, **self.feature_params)
+        if corners is None:
+            return np.empty((0, 2), np.float32)
+        corners = corners.reshape(-1, 2)
+        if len(existing) == 0:
+            return corners
+
+        # drop new corners in a min_distance cell already holding a tracked feature
+        cell = float(self.min_distance)
+        width = int(image.shape[1] // cell) + 1
+        occupied = np.zeros((int(image.shape[0] // cell) + 1) * width, bool)
+        existing_cells = (existing[:, 1] // cell).astype(np.int64) * width + (existing[:, 0] // cell).astype(np.int64)
+        occupied[np.clip(existing_cells, 0, len(occupied) - 1)] = True
+        corner_cells = (corners[:, 1] // cell).astype(np.int64) * width + (corners[:, 0] // cell).astype(np.int64)
+        return corners[~occupied[np.clip(corner_cells, 0, len(occupied) - 1)]]
+
+    def _add_points(self, new_points):
+        new_points = new_points[:max(self.max_corners - len(self.points), 0)]
+        self.points = np.concatenate([self.points, new_points.astype(np.float32)])
+        self.ids = np.concatenate([self.ids, np.arange(self.next_id, self.next_id + len(new_points))])
+        self.next_id += len(new_points)
+
+    def track(self, image):
+        # Tracks the features of the previous frame into `image`.
+        # returns the (M,2) src/dst correspondences, they are the first M entries
+        # of self.points after the call (re-detected features are appended after them)
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        src_pts = dst_pts = np.empty((0, 2), np.float32)
+        if self.prev_image is not None and len(self.points) > 0:
+            tracked, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_image, image, self.points, None, **self.lk_params)
+            # keep the features found inside the image
+            good = status.ravel() == 1
+            h, w = image.shape[:2]
+            good &= (tracked[:, 0] >= 0) & (tracked[:, 0] < w) & (tracked[:, 1] >= 0) & (tracked[:, 1] < h)
+            src_pts = self.points[good]
+            dst_pts = tracked.reshape(-1, 2)[good]
+            self.ids = self.ids[good]
+        self.points = dst_pts
+
+        if len(self.points) < self.min_tracked:
+            self._add_points(self._detect(image, self.points))
+
+        # the pyramids of the next call are built from this frame
+        self.prev_image = image
+        return src_pts, dst_pts
+
+    def discard(self, keep):
+        # drop tracked features, keep is a bool mask over the correspondences
+        # returned by the last track() call, e.g. the RANSAC inliers
+        keep = np.concatenate([keep, np.ones(len(self.points) - len(keep), bool)])
+        self.points = self.points[keep]
+        self.ids = self.ids[keep]
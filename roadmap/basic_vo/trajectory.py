@@ -0,0 +1,178 @@
+import numpy as np
+
+# Camera trajectory of a VO run. Poses are camera to world (4,4) matrices in
+# one preallocated float64 array grown by doubling, so appending is amortized
+# O(1) and a 100k frame sequence is a single (N,4,4) array, not N objects.
+# The KITTI and TUM text exports format all the numbers with vectorized NumPy
+# into fixed width ASCII rows written through a memory map.
+
+
+def rotation_to_quaternion(R):
+    # (N,3,3) rotation matrices to (N,4) unit quaternions (qx, qy, qz, qw), qw >= 0
+    R = np.asarray(R, dtype=np.float64).reshape(-1, 3, 3)
+    m00, m11, m22 = R[:, 0, 0], R[:, 1, 1], R[:, 2, 2]
+    # |q_k| from the diagonal, the signs from the off diagonal differences
+    q = 0.5 * np.sqrt(np.maximum(0.0, np.stack([1 + m00 - m11 - m22, 1 - m00 + m11 - m22,
+                                                1 - m00 - m11 + m22, 1 + m00 + m11 + m22], axis=1)))
+    q[:, 0] = np.copysign(q[:, 0], R[:, 2, 1] - R[:, 1, 2])
+    q[:, 1] = np.copysign(q[:, 1], R[:, 0, 2] - R[:, 2, 0])
+    q[:, 2] = np.copysign(q[:, 2], R[:, 1, 0] - R[:, 0, 1])
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def format_scientific(values, digits=9):
+    # (...) float64 values to (..., digits + 7) uint8 ASCII, byte identical to
+    # "% .{digits}e" for 1e-99 <= |x| < 1e100 (two exponent digits), -0.0
+    # included. |x| < 1e-99 is written as a signed zero, nan and inf as
+    # "% e" does, padded with spaces, and |x| >= 1e100 raises ValueError.
+    # The digits are computed with vectorized float64 arithmetic, the values
+    # too close to a rounding tie for that are formatted by Python instead:
+    # rare at the default 9 digits, but all of them from about 15 digits on,
+    # so more digits than the default are slow.
+    v = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(v)
+    a = np.where(finite, np.abs(v), 0.0)
+    a = np.where(a < 1e-99, 0.0, a)
+    exponent = np.floor(np.log10(np.where(a > 0, a, 1.0))).astype(np.int64)
+    scaled = a / 10.0**(exponent - digits)
+    # the scaling is exact to a few ulps, closer to .5 the rounding is unknown
+    tie = np.abs(scaled - np.floor(scaled) - 0.5) <= scaled * 2.0**-48
+    mantissa = np.rint(scaled).astype(np.int64)
+    # fix the exponent when log10 was off by one or the mantissa rounded up to 10.000
+    exponent += mantissa >= 10**(digits + 1)
+    exponent -= (mantissa < 10**digits) & (a > 0)
+    if np.any(exponent > 99):
+        raise ValueError("values of magnitude >= 1e100 don't fit the fixed width format")
+    scaled = a / 10.0**(exponent - digits)
+    tie |= np.abs(scaled - np.floor(scaled) - 0.5) <= scaled * 2.0**-48
+    mantissa = np.rint(scaled).astype(np.int64)
+
+    out = np.empty(v.shape + (digits + 7,), np.uint8)
+    out[..., 0] = np.where(np.signbit(v), ord('-'), ord(' '))
+    powers = 10**np.arange(digits, -1, -1, dtype=np.int64)
+    numerals = (mantissa[..., None] // powers) % 10 + ord('0')
+    out[..., 1] = numerals[..., 0]
+    out[..., 2] = ord('.')
+    out[..., 3:3 + digits] = numerals[..., 1:]
+    out[..., 3 + digits] = ord('e')
+    out[..., 4 + digits] = np.where(exponent < 0, ord('-'), ord('+'))
+    out[..., 5 + digits] = np.abs(exponent) // 10 + ord('0')
+    out[..., 6 + digits] = np.abs(exponent) % 10 + ord('0')
+
+    # ties, nan and inf: Python's correctly rounded formatting (tiny values
+    # below 1e-99 keep their signed zero)
+    fallback = (tie & (a > 0)) | ~finite
+    for index in zip(*np.nonzero(fallback)):
+        text = ("% .*e" % (digits, v[index])).ljust(digits + 7).encode()
+        out[index] = np.frombuffer(text, np.uint8)
+    return out
+
+
+def write_rows(path, columns, digits=None, chunk_rows=65536):
+    # Writes the (N,k) columns as N text lines of space separated numbers.
+    # digits is the number of decimals of every column (9 by default). Every
+    # line has the same width, so the file is sized up front and the rows are
+    # formatted and copied into a memory map chunk by chunk.
+    columns = np.asarray(columns, dtype=np.float64)
+    n, k = columns.shape
+    digits = [9] * k if digits is None else list(digits)
+    widths = np.array(digits) + 7
+    line = int(widths.sum()) + k
+    if n == 0:
+        open(path, "wb").close()
+        return
+    out = np.memmap(path, dtype=np.uint8, mode="w+", shape=(n * line,))
+    starts = np.concatenate([[0], np.cumsum(widths + 1)[:-1]])
+    for begin in range(0, n, chunk_rows):
+        end = min(begin + chunk_rows, n)
+        rows = np.empty((end - begin, line), np.uint8)
+        for c in range(k):
+            rows[:, starts[c]:starts[c] + widths[c]] = format_scientific(columns[begin:end, c], digits[c])
+            rows[:, starts[c] + widths[c]] = ord(' ')
+        rows[:, -1] = ord('\n')
+        out[begin * line:end * line] = rows.ravel()
+    out.flush()
+    del out
+
+
+class Trajectory:
+    # poses[i] is the camera to world pose of the i-th appended frame,
+    # timestamps[i] its time (e.g. the frame index)
+    def __init__(self, capacity=1024):
+        self._poses = np.empty((capacity, 4, 4))
+        self._timestamps = np.empty(capacity)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def poses(self):
+        return self._poses[:self.count]
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self.count]
+
+    @property
+    def positions(self):
+        # (N,3) camera centres in the world frame
+        return self.poses[:, :3, 3]
+
+    def _grow(self):
+        capacity = 2 * len(self._poses)
+        self._poses = np.concatenate([self._poses, np.empty((capacity - len(self._poses), 4, 4))])
+        self._timestamps = np.concatenate([self._timestamps, np.empty(capacity - len(self._timestamps))])
+
+    def append(self, pose, timestamp):
+        # pose is the (4,4) or (3,4) camera to world pose
+        if self.count == len(self._poses):
+            self._grow()
+        self._poses[self.count, :3] = np.asarray(pose)[:3]
+        self._poses[self.count, 3] = (0, 0, 0, 1)
+        self._timestamps[self.count] = timestamp
+        self.count += 1
+
+    def append_relative(self, R, t, timestamp):
+        # Composes the motion [R|t] of the camera since the last pose, x_new = R x_last + t
+        # as given by the essential matrix decomposition. The first call starts at the origin.
+        if self.count == 0:
+            self.append(np.eye(4), timestamp)
+            return
+        if self.count == len(self._poses):
+            self._grow()
+        last = self._poses[self.count - 1]
+        # camera to world of the new frame: last @ [R|t]^-1 = last @ [R^T | -R^T t]
+        R_inv = np.asarray(R).T
+        pose = self._poses[self.count]
+        pose[:3, :3] = last[:3, :3] @ R_inv
+        pose[:3, 3] = last[:3, 3] - pose[:3, :3] @ np.asarray(t, dtype=np.float64).ravel()
+        pose[3] = (0, 0, 0, 1)
+        self._timestamps[self.count] = timestamp
+        self.count += 1
+
+    def frame_poses(self, frame_count=None):
+        # (frame_count,4,4) poses of every frame when the timestamps are frame
+        # indices: frames without a pose (not estimated, skipped between
+        # keyframes) keep the last pose before them, frames before the first
+        # pose take the first one. frame_count defaults to the last timestamp + 1.
+        frames = np.rint(self.timestamps).astype(np.int64)
+        if np.any(np.diff(frames) < 0):
+            raise ValueError("the timestamps aren't increasing frame indices")
+        if frame_count is None:
+            frame_count = frames[-1] + 1 if self.count else 0
+        last = np.searchsorted(frames, np.arange(frame_count), side="right") - 1
+        return self.poses[np.maximum(last, 0)]
+
+    def save_kitti(self, path, frame_count=None):
+        # KITTI odometry format: the first 3 rows of a pose, row major, per
+        # line. KITTI has no timestamps, line i is frame i (see frame_poses).
+        write_rows(path, self.frame_poses(frame_count)[:, :3, :].reshape(-1, 12))
+
+    def save_tum(self, path, time_scale=1.0):
+        # TUM RGB-D format: "timestamp tx ty tz qx qy qz qw" per line,
+        # time_scale converts the stored timestamps to seconds (e.g. 1 / fps).
+        # 10 significant digits are microseconds up to 1e4 s
+        columns = np.column_stack([self.timestamps * time_scale, self.positions,
+                                   rotation_to_quaternion(self.poses[:, :3, :3])])
+        write_rows(path, columns)
@@ -1,8 +1,9 @@
 import cv2
 import numpy as np  
 from matplotlib import pyplot as plt
-from roadmap.epipolar_geo.rectification_stereo import estimate_essential_matrix, decompose_essential_matrix, \
+from roadmap.epipolar_geo.rectification_stereo import estimate_essential_matrix, decompose_essential_matrix_poses, \
                 validate_cheirality_condition, get_3d_triangulated_points
+from roadmap.epipolar_geo.epipolar_lines import compute_epipolar_lines, draw_epipolar_lines
 
 
 imgs_name = [
@@ -23,8 +24,9 @@ def load_image_from_asset(filename):
 
 def orb_keypoints(images):
     kp_des_list = []
+    # a single ORB instance is shared by all the images
+    orb = cv2.ORB_create()
     for image in images:
-        orb = cv2.ORB_create()
         # find the keypoints with ORB
         kp = orb.detect(image,None)
         # compute the descriptors with ORB
@@ -78,24 +80,13 @@ def feature_matching_with_ransac(images, kp_des_list):
 
     return fundamental_mat, kp1, kp2, ransac_matches, src_pts_ransac, dst_pts_ransac
 
-def to_homogeneous_points(pts):
-    return np.array([pts[0], pts[1], 1]).reshape(3,1)
-
 def compute_epipolar_line(fundamental_mat, pts):
-    homogeneous_pts = to_homogeneous_points(pts)
-    homogeneous_epipolar_line = fundamental_mat@homogeneous_pts
-    return homogeneous_epipolar_line.T[0]
-
-def draw_epipolar_line(img, epipolar_line):
-    # Determine two points on the epipolar line
-    a,b,c = epipolar_line
-    y1 = (-c - a*0) / b
-    y2 = (-c - a*img.shape[1]) / b
-    pt1 = (0, int(y1))
-    pt2 = (img.shape[1], int(y2))
+    # line (a, b, c) of a single point, see compute_epipolar_lines for point sets
+    return compute_epipolar_lines(fundamental_mat, [pts])[0]
 
-    # Draw the epipolar line on the image
-    return cv2.line(img, pt1, pt2, (0, 255, 0), 2)  # Drawing the line in green color with thickness 2
+def draw_epipolar_line(img, epipolar_line, color=(0, 255, 0)):
+    # Drawing the line clipped to the image, vertical lines included (b = 0)
+    return draw_epipolar_lines(img, [epipolar_line], color)
 
 
 
@@ -142,10 +133,13 @@ def main():
     display_window("Stereo Image", img0)
     close_window()
 
-    epipolar_line = compute_epipolar_line(fundamental_mat, selected_point)
-    print(epipolar_line)
-
-    annotated_img = draw_epipolar_line(img1, epipolar_line)
+    # the lines of all the RANSAC inliers in one pass, then the selected point in red
+    epipolar_lines = compute_epipolar_lines(fundamental_mat, src_pts)
+    annotated_img = draw_epipolar_lines(img1, epipolar_lines, thickness=1)
+    if selected_point is not None:
+        epipolar_line = compute_epipolar_line(fundamental_mat, selected_point)
+        print(epipolar_line)
+        annotated_img = draw_epipolar_line(annotated_img, epipolar_line, (0, 0, 255))
     display_window("EPIPOLAR LINES",annotated_img)
     close_window()
 
@@ -153,9 +147,10 @@ def main():
     essential_mat = estimate_essential_matrix(fundamental_mat, INTRINSIC_MATRIX, INTRINSIC_MATRIX)
     print("Essential Matrix " , essential_mat)
 
-    # get possible rotation and translation matrices
-    possible_rotations, possible_translations = decompose_essential_matrix(essential_matrix=essential_mat)
-    print(possible_rotations[0].shape)
+    # get all four possible rotation and translation hypotheses
+    possible_poses = decompose_essential_matrix_poses(essential_mat)
+    possible_rotations, possible_translations = possible_poses[:, :, :3], possible_poses[:, :, 3:]
+    print(possible_poses.shape)
 
     # cheirality verification
     R,t = validate_cheirality_condition(INTRINSIC_MATRIX, possible_rotations, possible_translations, src_pts[0], dst_pts[0])
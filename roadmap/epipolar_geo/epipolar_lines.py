@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+
+from roadmap.epipolar_geo.hypothesis_scoring import to_homogeneous
+
+# Epipolar lines of whole point sets, e.g. every inlier of a frame for QA.
+# The (N,3) lines l = F x of (N,2) points are one matmul, their clipping to
+# the image rectangle is vectorized over the lines and all the visible
+# segments are drawn with a single cv2.polylines call.
+
+
+def compute_epipolar_lines(fundamental_mat, pts):
+    # (N,2) points of the first image to the (N,3) lines a x + b y + c = 0 of
+    # the second one, scaled so that a^2 + b^2 = 1 (|a x + b y + c| is then
+    # the distance of (x, y) to the line in pixels). The transposed
+    # fundamental matrix gives the lines in the first image of points of the second.
+    lines = to_homogeneous(pts) @ np.asarray(fundamental_mat, dtype=np.float64).T
+    norm = np.hypot(lines[:, 0], lines[:, 1])
+    # F x = 0 only at the epipole, which has no line
+    return lines / np.where(norm > 0, norm, 1.0)[:, None]
+
+
+def clip_lines(lines, width, height):
+    # Clips the (N,3) lines to the image [0, width - 1] x [0, height - 1].
+    # returns the (N,2,2) end points (x, y) of the visible segments and the
+    # (N,) mask of the lines that cross the image
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 3)
+    a, b, c = lines[:, 0:1], lines[:, 1:2], lines[:, 2:3]
+    right, bottom = width - 1.0, height - 1.0
+    # intersections with x = 0, x = right (not for vertical lines, b = 0)
+    # and with y = 0, y = bottom (not for horizontal lines, a = 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        border_x = np.array([0.0, right])
+        border_y = np.array([0.0, bottom])
+        y_at = -(c + a * border_x) / b
+        x_at = -(c + b * border_y) / a
+    candidates = np.concatenate([np.stack([np.broadcast_to(border_x, y_at.shape), y_at], axis=2),
+                                 np.stack([x_at, np.broadcast_to(border_y, x_at.shape)], axis=2)], axis=1)
+    tolerance = 1e-9 * max(width, height)
+    inside = np.isfinite(candidates).all(axis=2) \
+        & (candidates[..., 0] >= -tolerance) & (candidates[..., 0] <= right + tolerance) \
+        & (candidates[..., 1] >= -tolerance) & (candidates[..., 1] <= bottom + tolerance)
+
+    # the end points are the extreme intersections along the line direction (-b, a)
+    with np.errstate(invalid='ignore'):
+        position = candidates[..., 1] * a - candidates[..., 0] * b
+    first = np.argmin(np.where(inside, position, np.inf), axis=1)
+    last = np.argmax(np.where(inside, position, -np.inf), axis=1)
+    rows = np.arange(len(lines))
+    segments = np.stack([candidates[rows, first], candidates[rows, last]], axis=1)
+    visible = inside.any(axis=1)
+    segments[~visible] = 0
+    return segments, visible
+
+
+def draw_epipolar_lines(img, lines, color=(0, 255, 0), thickness=2):
+    # draws the visible part of all the (N,3) lines on img in one call
+    segments, visible = clip_lines(lines, img.shape[1], img.shape[0])
+    if not visible.any():
+        return img
+    return cv2.polylines(img, np.rint(segments[visible]).astype(np.int32), False, color, thickness)
@@ -0,0 +1,69 @@
+import numpy as np
+
+# Scoring of many RANSAC hypotheses at once. A (K,3,3) stack of fundamental
+# (pixel points) or essential (normalized points) matrices is scored against
+# N correspondences with one broadcast over all K models per chunk of points,
+# the chunks are sized so the (K,chunk,3) intermediates stay in cache.
+
+
+def to_homogeneous(pts):
+    # (N,2) points to (N,3) float64 [x, y, 1]
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    return np.column_stack([pts, np.ones(len(pts))])
+
+
+def _sampson_chunk(models, h1, h2):
+    # (K,n) squared Sampson distances of homogeneous points h1, h2 (n,3)
+    Fx1 = h1 @ np.swapaxes(models, 1, 2)
+    Ftx2 = h2 @ models
+    x2tFx1 = (Fx1 * h2).sum(axis=2)
+    denominator = Fx1[..., 0]**2 + Fx1[..., 1]**2 + Ftx2[..., 0]**2 + Ftx2[..., 1]**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return x2tFx1**2 / denominator
+
+
+def chunk_size(n_models, chunk_bytes):
+    # points per chunk, about 5 (K,chunk,3) float64 intermediates in chunk_bytes
+    return max(int(chunk_bytes // (n_models * 5 * 3 * 8)), 1)
+
+
+def sampson_errors(models, pts1, pts2, chunk_bytes=1 << 20, out=None):
+    # (K,N) squared Sampson distance of every correspondence pts1[n] <-> pts2[n]
+    # to every model of the (K,3,3) stack. out is an optional (K,N) buffer.
+    models = np.asarray(models, dtype=np.float64).reshape(-1, 3, 3)
+    h1, h2 = to_homogeneous(pts1), to_homogeneous(pts2)
+    K, N = len(models), len(h1)
+    if out is None:
+        out = np.empty((K, N))
+
+    step = chunk_size(K, chunk_bytes)
+    for start in range(0, N, step):
+        stop = min(start + step, N)
+        out[:, start:stop] = _sampson_chunk(models, h1[start:stop], h2[start:stop])
+    return out
+
+
+def score_hypotheses(models, pts1, pts2, threshold, chunk_bytes=1 << 20):
+    # (K,) inlier count of every model, inliers have a Sampson distance below
+    # `threshold` (same units as the points). Only the counts are accumulated,
+    # the (K,N) error matrix is never built.
+    models = np.asarray(models, dtype=np.float64).reshape(-1, 3, 3)
+    h1, h2 = to_homogeneous(pts1), to_homogeneous(pts2)
+    threshold_sq = threshold**2
+    counts = np.zeros(len(models), np.int64)
+
+    step = chunk_size(len(models), chunk_bytes)
+    for start in range(0, len(h1), step):
+        stop = min(start + step, len(h1))
+        # NaN errors (degenerate models) compare False, they are never inliers
+        counts += (_sampson_chunk(models, h1[start:stop], h2[start:stop]) < threshold_sq).sum(axis=1)
+    return counts
+
+
+def best_hypothesis(models, pts1, pts2, threshold, chunk_bytes=1 << 20):
+    # index, inlier count and (N,) inlier mask of the model with most inliers
+    models = np.asarray(models, dtype=np.float64).reshape(-1, 3, 3)
+    counts = score_hypotheses(models, pts1, pts2, threshold, chunk_bytes)
+    best = int(np.argmax(counts))
+    mask = sampson_errors(models[best], pts1, pts2, chunk_bytes)[0] < threshold**2
+    return best, int(counts[best]), mask
@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-from scipy.linalg import svd
 
 # 3. **Estimate Motion**: Using the matched points, estimate the camera's motion between the two images. 
 # This is typically done using techniques like the eight-point algorithm for fundamental matrix estimation, 
@@ -11,48 +10,140 @@ def estimate_essential_matrix(FundamentalMatrix, left_intrinsic_matrix, right_in
     return (left_intrinsic_matrix.T)@FundamentalMatrix@right_intrinsic_matrix
 
 def decompose_essential_matrix(essential_matrix):
-    # Singular Value Decomposition (SVD)
-    U, S, Vt = svd(essential_matrix)
-
-    # define W 
-    # The product UWVT gives one of the possible rotation matrices. 
-    # This is because W represents a rotation of 90 degrees about the z-axis. 
-    # When you multiply U and VT with W in between, 
-    # you're effectively combining the rotations from the two camera views with this 90-degree rotation. 
-    # This results in one of the possible rotation matrices that align the two camera views based on the epipolar geometry.
-    W = np.array([
-            [0, -1, 0],
-            [1,  0, 0],
-            [0,  0, 1]
-    ])
-
-    # two possible rotation matrices
-    Rot_1 = U @ W   @ Vt
-    Rot_2 = U @ W.T @ Vt
-
-    # Ensure the rotation matrices are proper rotations (det(R) = 1)
-    if np.linalg.det(Rot_1) < 0:
-        Rot_1 = -Rot_1
-    if np.linalg.det(Rot_2) < 0:
-        Rot_2 = -Rot_2
-
-    # Two possible translation vectors
-    tra_1 = U[:, 2].reshape(3,1)
-    tra_2 = -U[:, 2].reshape(3,1)
-
-    return [Rot_1, Rot_2], [tra_1, tra_2]
-
-def get_3d_triangulated_points(K, rot, tra, pts1, pts2):
+    # two rotations and two translations, kept for the older callers.
+    # All four (R, t) combinations are in decompose_essential_matrix_poses.
+    poses = decompose_essential_matrix_poses(essential_matrix)
+    return [poses[0, :, :3], poses[2, :, :3]], [poses[0, :, 3:], poses[1, :, 3:]]
+
+
+def _det3(M):
+    # closed form determinant of a stack of 3x3 matrices, row_0 . (row_1 x row_2)
+    return np.einsum('...i,...i->...', M[..., 0, :], np.cross(M[..., 1, :], M[..., 2, :]))
+
+
+def decompose_essential_matrix_poses(essential_matrix, out=None):
+    # All four (R, t) hypotheses of an essential matrix as one stacked
+    # (4,3,4) array of [R|t]: (R1, t), (R1, -t), (R2, t), (R2, -t).
+    # essential_matrix can also be a (...,3,3) stack, the result is then
+    # (...,4,3,4), and `out` can be given to reuse a preallocated buffer.
+    E = np.asarray(essential_matrix, dtype=np.float64)
+    if out is None:
+        out = np.empty(E.shape[:-2] + (4, 3, 4))
+
+    # Singular Value Decomposition (SVD), numpy's batched LAPACK call works on
+    # the whole stack without scipy's per call checks
+    U, _, Vt = np.linalg.svd(E)
+
+    # E = U S Vt is unchanged (up to sign) by flipping U or Vt, flip them so
+    # both are proper rotations. Then U W Vt is always a rotation and no
+    # determinant of the result has to be checked.
+    U *= np.where(_det3(U) < 0, -1.0, 1.0)[..., None, None]
+    Vt *= np.where(_det3(Vt) < 0, -1.0, 1.0)[..., None, None]
+
+    # W is a rotation of 90 degrees about the z-axis, so U @ W and U @ W.T
+    # are only a permutation of U's columns:
+    # U @ W = [u1, -u0, u2] and U @ W.T = [-u1, u0, u2]
+    UW = np.empty_like(U)
+    UW[..., :, 0] = U[..., :, 1]
+    UW[..., :, 1] = -U[..., :, 0]
+    UW[..., :, 2] = U[..., :, 2]
+    np.matmul(UW, Vt, out=out[..., 0, :, :3])
+    UW[..., :, :2] *= -1
+    np.matmul(UW, Vt, out=out[..., 2, :, :3])
+    out[..., 1, :, :3] = out[..., 0, :, :3]
+    out[..., 3, :, :3] = out[..., 2, :, :3]
+
+    # the translation is the left null vector of E, up to sign
+    out[..., 0, :, 3] = U[..., :, 2]
+    out[..., 2, :, 3] = U[..., :, 2]
+    out[..., 1, :, 3] = -U[..., :, 2]
+    out[..., 3, :, 3] = -U[..., :, 2]
+    return out
+
+
+def get_projection_matrices(K, rotations, translations):
+    # (C,3,4) projection matrices K[R|t] of the second camera for every (R, t)
+    # candidate, the first camera is always K[I|0]
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 3, 1)
     Projection_1 = K @ np.hstack([np.eye(3), np.zeros((3, 1))])
-    Projection_2 = K @ np.hstack([rot, tra])
+    Projection_2 = K @ np.concatenate([rotations, translations], axis=2)
+    return Projection_1, Projection_2
+
+
+def triangulate_points_batch(K, rotations, translations, pts1, pts2):
+    # Linear triangulation of all N correspondences for all C (R, t)
+    # candidates at once. In normalized image coordinates every point gives the
+    # rows x*P[2] - P[0] and y*P[2] - P[1] of both cameras, a 4x3 system
+    # A X = -a that is solved through its 3x3 normal equations with the closed
+    # form inverse (cross products of the columns), so the whole (C,N) stack
+    # is a handful of array ops instead of a batched SVD.
+    # returns the (C,N,3) points in the first camera frame and the (C,N)
+    # determinant of the normal equations, 0 for rays that don't intersect
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 3)
+    K_inv = np.linalg.inv(K)
+    pts1 = np.asarray(pts1, dtype=np.float64).reshape(-1, 2) @ K_inv[:2, :2].T + K_inv[:2, 2]
+    pts2 = np.asarray(pts2, dtype=np.float64).reshape(-1, 2) @ K_inv[:2, :2].T + K_inv[:2, 2]
+    C, N = len(rotations), len(pts1)
+
+    A = np.zeros((C, N, 4, 3))
+    a = np.zeros((C, N, 4))
+    # first camera is [I|0]
+    A[:, :, 0, 0] = -1
+    A[:, :, 0, 2] = pts1[:, 0]
+    A[:, :, 1, 1] = -1
+    A[:, :, 1, 2] = pts1[:, 1]
+    # second camera is [R|t], one per candidate
+    A[:, :, 2] = pts2[None, :, 0:1] * rotations[:, None, 2] - rotations[:, None, 0]
+    A[:, :, 3] = pts2[None, :, 1:2] * rotations[:, None, 2] - rotations[:, None, 1]
+    a[:, :, 2] = pts2[None, :, 0] * translations[:, None, 2] - translations[:, None, 0]
+    a[:, :, 3] = pts2[None, :, 1] * translations[:, None, 2] - translations[:, None, 1]
+
+    # normal equations M X = b
+    M = np.einsum('cnri,cnrj->cnij', A, A)
+    b = -np.einsum('cnri,cnr->cni', A, a)
+    # M is symmetric, its inverse is the rows m1 x m2, m2 x m0, m0 x m1 over det(M)
+    adjugate = np.stack([np.cross(M[..., 1, :], M[..., 2, :]),
+                         np.cross(M[..., 2, :], M[..., 0, :]),
+                         np.cross(M[..., 0, :], M[..., 1, :])], axis=-2)
+    det = np.einsum('...i,...i->...', M[..., 0, :], adjugate[..., 0, :])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        points_3D = np.einsum('...ij,...j->...i', adjugate, b) / det[..., None]
+    return points_3D, det
 
-    points3d = []
-    for pt1, pt2 in zip(pts1, pts2):
-        points_3D_homogeneous = cv2.triangulatePoints(Projection_1, Projection_2, pt1, pt2)
-        # Convert from homogeneous to regular 3D coordinates
-        points_3D = points_3D_homogeneous[:3] / points_3D_homogeneous[3]
-        points3d.append(points_3D.ravel())
-    return np.array(points3d).T, Projection_1, Projection_2
+
+def get_3d_triangulated_points(K, rot, tra, pts1, pts2):
+    Projection_1, Projection_2 = get_projection_matrices(K, [rot], [tra])
+    points_3D, _ = triangulate_points_batch(K, [rot], [tra], pts1, pts2)
+    return points_3D[0].T, Projection_1, Projection_2[0]
+
+
+def cheirality_masks(K, rotations, translations, pts1, pts2):
+    # (C,N) mask of the points that triangulate in front of both cameras
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 3)
+    points_3D, det = triangulate_points_batch(K, rotations, translations, pts1, pts2)
+
+    # depth in the first camera
+    depth_1 = points_3D[..., 2]
+    # depth in the second camera, z component of R @ X + t
+    depth_2 = np.einsum('cj,cnj->cn', rotations[:, 2], points_3D) + translations[:, None, 2]
+    return (det > 1e-12) & (depth_1 > 0) & (depth_2 > 0)
+
+
+def select_pose_by_cheirality(K, rotations_arr, translation_arr, pts1, pts2):
+    # Triangulate every correspondence for every (R, t) candidate and keep the
+    # candidate with the most points in front of both cameras. A few noisy
+    # inliers can no longer decide the pose on their own.
+    # returns R, t, the (N,) in-front mask of the chosen candidate and the
+    # (C,) number of points in front for every candidate
+    rotations = np.asarray(rotations_arr, dtype=np.float64).reshape(-1, 3, 3)
+    translations = np.asarray(translation_arr, dtype=np.float64).reshape(-1, 3, 1)
+    masks = cheirality_masks(K, rotations, translations, pts1, pts2)
+    counts = masks.sum(axis=1)
+    best = int(np.argmax(counts))
+    return rotations[best], translations[best], masks[best], counts
 
 
 def validate_cheirality_condition(K, rotations_arr, translation_arr, pt1, pt2):
@@ -86,31 +177,10 @@ def validate_cheirality_condition(K, rotations_arr, translation_arr, pt1, pt2):
 
 
 def validate_cheirality_condition_all_pts(K, rotations_arr, translation_arr, pts1, pts2):
-    for R, t in zip(rotations_arr, translation_arr):
-        # print("=======")
-        # Triangulate a Point:
-        # For each of the four possible (R, t) combinations, triangulate a 3D point using the matched 2D points from the two images.
-        Projection_1 = K @ np.hstack([np.eye(3), np.zeros((3, 1))])
-
-        # print("R ", R.shape)
-        # print("t ", t.shape)
-        Projection_2 = K @ np.hstack([R, t])
-
-        for pt1, pt2 in zip(pts1, pts2):
-            # Triangulate using OpenCV
-            X_homogeneous = cv2.triangulatePoints(Projection_1, Projection_2, pt1, pt2)
-            X = X_homogeneous[:3] / X_homogeneous[3]
-
-            # print("Triangulated 3D point:", X)
-            # Check if the point is in front of the first camera
-            if X[2] <= 0:
-                continue
-
-            # Transform the point to the second camera's coordinate system
-            X_transformed = R @ X + t
-            # print("Transformed 3D point:", X_transformed)
-            # Check if the point is in front of the second camera
-            if X_transformed[2] > 0:
-                return R, t
-        
-    return None, None
\ No newline at end of file
+    # all the points of all the (R, t) candidates are checked in one batched pass
+    if len(pts1) == 0:
+        return None, None
+    R, t, mask, _ = select_pose_by_cheirality(K, rotations_arr, translation_arr, pts1, pts2)
+    if not mask.any():
+        return None, None
+    return R, t
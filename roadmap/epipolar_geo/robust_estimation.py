@@ -0,0 +1,246 @@
+import itertools
+
+import numpy as np
+
+from roadmap.epipolar_geo.hypothesis_scoring import sampson_errors, score_hypotheses
+
+# Robust estimation of the essential matrix directly from calibrated
+# (normalized) correspondences: a minimal 5-point solver inside a RANSAC loop
+# with adaptive iteration count, PROSAC ordering by match quality and local
+# optimization (LO-RANSAC) of every new best model.
+
+######################
+# 5-point solver (Nister 2004, in the action matrix form of Stewenius et al. 2006)
+#
+# The 5 epipolar constraints x2^T E x1 = 0 leave a 4 dimensional null space,
+# E = x X + y Y + z Z + W. The cubic constraints det(E) = 0 and
+# 2 E E^T E - tr(E E^T) E = 0 give 10 polynomial equations in the 20 monomials
+# of degree <= 3 in (x, y, z), which are solved with a 10x10 action matrix.
+
+# monomials of degree <= 3 as exponents of (x, y, z), cubic ones first
+MONOMIALS = [
+    (3, 0, 0), (2, 1, 0), (2, 0, 1), (1, 2, 0), (1, 1, 1), (1, 0, 2), (0, 3, 0), (0, 2, 1), (0, 1, 2), (0, 0, 3),
+    (2, 0, 0), (1, 1, 0), (1, 0, 1), (0, 2, 0), (0, 1, 1), (0, 0, 2), (1, 0, 0), (0, 1, 0), (0, 0, 1), (0, 0, 0),
+]
+# the degree <= 1 and degree <= 2 polynomials use the tail of the same list
+MONOMIALS_1 = MONOMIALS[16:]
+MONOMIALS_2 = MONOMIALS[10:]
+
+
+def _product_table(left, right):
+    # T[i, j, k] = 1 when left_i * right_j = MONOMIALS_k, flattened to (i*j, k) so
+    # that the coefficients of a product are outer(p, q).ravel() @ T
+    index = {m: k for k, m in enumerate(MONOMIALS)}
+    table = np.zeros((len(left), len(right), len(MONOMIALS)))
+    for (i, a), (j, b) in itertools.product(enumerate(left), enumerate(right)):
+        table[i, j, index[(a[0] + b[0], a[1] + b[1], a[2] + b[2])]] = 1
+    return table.reshape(len(left) * len(right), len(MONOMIALS))
+
+
+# degree 1 x degree 1 -> degree 2 (only the last 10 columns can be non zero)
+PRODUCT_11 = _product_table(MONOMIALS_1, MONOMIALS_1)[:, 10:]
+# degree 2 x degree 1 -> degree 3
+PRODUCT_21 = _product_table(MONOMIALS_2, MONOMIALS_1)
+
+# x times the basis [x^2, xy, xz, y^2, yz, z^2, x, y, z, 1] of the quotient ring:
+# [x^3, x^2y, x^2z, xy^2, xyz, xz^2] are reduced by the Gauss-Jordan step,
+# [x^2, xy, xz, x] are basis monomials themselves
+_ACTION_CUBIC_ROWS = [0, 1, 2, 3, 4, 5]
+_ACTION_BASIS_ROWS = [(6, 0), (7, 1), (8, 2), (9, 6)]
+
+
+def _mul_11(p, q):
+    # (..., 4) x (..., 4) degree 1 polynomials -> (..., 10) degree 2
+    outer = p[..., :, None] * q[..., None, :]
+    return outer.reshape(outer.shape[:-2] + (16,)) @ PRODUCT_11
+
+
+def _mul_21(p, q):
+    # (..., 10) degree 2 x (..., 4) degree 1 polynomials -> (..., 20) degree 3
+    outer = p[..., :, None] * q[..., None, :]
+    return outer.reshape(outer.shape[:-2] + (40,)) @ PRODUCT_21
+
+
+def normalize_points(pts, K):
+    # pixel coordinates to normalized image coordinates K^-1 [u, v, 1]
+    K_inv = np.linalg.inv(K)
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    return pts @ K_inv[:2, :2].T + K_inv[:2, 2]
+
+
+def epipolar_constraint_rows(x1, x2):
+    # rows of Q with Q vec(E) = 0 for x2^T E x1 = 0, vec(E) row major
+    return np.column_stack([
+        x2[:, 0] * x1[:, 0], x2[:, 0] * x1[:, 1], x2[:, 0],
+        x2[:, 1] * x1[:, 0], x2[:, 1] * x1[:, 1], x2[:, 1],
+        x1[:, 0], x1[:, 1], np.ones(len(x1)),
+    ])
+
+
+def five_point_essential(x1, x2):
+    # Up to 10 essential matrices, as a (S,3,3) stack, from exactly 5
+    # normalized correspondences x1, x2 (5,2)
+    _, _, Vt = np.linalg.svd(epipolar_constraint_rows(x1, x2))
+    basis = Vt[5:].reshape(4, 3, 3)
+
+    # E as a 3x3 matrix of degree 1 polynomials in (x, y, z), coefficients of [x, y, z, 1]
+    E = np.moveaxis(basis, 0, -1)
+
+    # det(E) = e0 . (e1 x e2)
+    e0, e1, e2 = E[0], E[1], E[2]
+    cross = _mul_11(e1[[1, 2, 0]], e2[[2, 0, 1]]) - _mul_11(e1[[2, 0, 1]], e2[[1, 2, 0]])
+    det = _mul_21(cross, e0).sum(axis=0)
+
+    # 2 E E^T E - tr(E E^T) E
+    EEt = _mul_11(E[:, None, :, :], E[None, :, :, :]).sum(axis=2)
+    trace = EEt[0, 0] + EEt[1, 1] + EEt[2, 2]
+    EEtE = _mul_21(EEt[:, :, None, :], E[None, :, :, :]).sum(axis=1)
+    trace_constraint = 2 * EEtE - _mul_21(trace, E)
+
+    A = np.vstack([det[None], trace_constraint.reshape(9, 20)])
+    try:
+        # Gauss-Jordan: cubic monomials = -B @ basis monomials
+        B = np.linalg.solve(A[:, :10], A[:, 10:])
+    except np.linalg.LinAlgError:
+        return np.empty((0, 3, 3))
+
+    action = np.zeros((10, 10))
+    action[:6] = -B[_ACTION_CUBIC_ROWS]
+    for row, col in _ACTION_BASIS_ROWS:
+        action[row, col] = 1
+
+    # the basis monomials evaluated at a solution are an eigenvector of the
+    # action matrix, (x, y, z) are read from the x, y, z and 1 entries
+    eigenvalues, eigenvectors = np.linalg.eig(action)
+    real = np.abs(eigenvalues.imag) < 1e-8
+    v = eigenvectors[:, real].real
+    v = v[:, np.abs(v[9]) > 1e-12]
+    xyz = v[6:9] / v[9]
+    Es = np.einsum('ks,kij->sij', xyz, basis[:3]) + basis[3]
+    return Es / np.linalg.norm(Es, axis=(1, 2), keepdims=True)
+
+
+def project_to_essential(E):
+    # closest essential matrix, singular values (1, 1, 0)
+    U, _, Vt = np.linalg.svd(E)
+    return U @ np.diag([1.0, 1.0, 0.0]) @ Vt
+
+
+def linear_essential(x1, x2):
+    # least squares (8+ points) essential matrix, used by the local optimization
+    _, _, Vt = np.linalg.svd(epipolar_constraint_rows(x1, x2))
+    return project_to_essential(Vt[-1].reshape(3, 3))
+
+
+######################
+# RANSAC engine
+
+def adaptive_iterations(inlier_ratio, sample_size, confidence, max_iterations):
+    # number of samples so that an all inlier sample is drawn with `confidence`
+    if inlier_ratio <= 0:
+        return max_iterations
+    p_good_sample = inlier_ratio**sample_size
+    if p_good_sample >= 1:
+        return 1
+    return int(min(max_iterations, np.ceil(np.log(1 - confidence) / np.log(1 - p_good_sample))))
+
+
+class ProsacSampler:
+    # PROSAC (Chum & Matas 2005) sampling over correspondences sorted best
+    # first: samples are drawn from a progressively growing top-n subset, so
+    # good matches are tried first and it degrades to plain RANSAC.
+    def __init__(self, n_points, sample_size, max_iterations, rng):
+        self.N = n_points
+        self.m = sample_size
+        self.rng = rng
+        self.n = sample_size
+        # expected number of samples drawn only from the top n points
+        self.T_n = float(max_iterations)
+        for i in range(sample_size):
+            self.T_n *= (self.n - i) / (self.N - i)
+        self.T_n_prime = 1
+        self.t = 0
+
+    def sample(self):
+        self.t += 1
+        if self.t == self.T_n_prime and self.n < self.N:
+            T_n_next = self.T_n * (self.n + 1) / (self.n + 1 - self.m)
+            self.n += 1
+            self.T_n_prime += int(np.ceil(T_n_next - self.T_n))
+            self.T_n = T_n_next
+        if self.T_n_prime < self.t:
+            # the growth schedule fell behind, m points from the top n
+            return self.rng.choice(self.n, self.m, replace=False)
+        # m - 1 points from the top n - 1 and the n-th point, so every newly
+        # added correspondence is tried
+        sample = self.rng.choice(self.n - 1, self.m - 1, replace=False)
+        return np.append(sample, self.n - 1)
+
+
+def estimate_essential_ransac(pts1, pts2, K, threshold=1.0, confidence=0.999, max_iterations=1000,
+                              match_distances=None, lo_iterations=5, batch_size=16, seed=0):
+    # Essential matrix of pixel correspondences pts1, pts2 (N,2) with the
+    # 5-point solver. threshold is the Sampson error threshold in pixels,
+    # match_distances (e.g. the Hamming distances of the matches) enable
+    # PROSAC ordering, lo_iterations the local optimization of new best models.
+    # The solutions of batch_size samples are scored together in one call.
+    # returns E, the (N,) inlier mask, the inlier ratio and the number of iterations
+    x1 = normalize_points(pts1, K)
+    x2 = normalize_points(pts2, K)
+    N = len(x1)
+    if N < 5:
+        raise ValueError("No matching was found !")
+
+    # pixel threshold in normalized coordinates
+    focal = (K[0, 0] + K[1, 1]) / 2.0
+    threshold = threshold / focal
+    threshold_sq = threshold**2
+    rng = np.random.default_rng(seed)
+
+    order = np.arange(N)
+    sampler = None
+    if match_distances is not None:
+        order = np.argsort(match_distances, kind="stable")
+        sampler = ProsacSampler(N, 5, max_iterations, rng)
+
+    best_E, best_mask, best_count = None, np.zeros(N, bool), 0
+    needed = max_iterations
+    iterations = 0
+    while iterations < min(needed, max_iterations):
+        batch = min(batch_size, min(needed, max_iterations) - iterations)
+        iterations += batch
+        solutions = []
+        for _ in range(batch):
+            if sampler is not None:
+                sample = order[sampler.sample()]
+            else:
+                sample = rng.choice(N, 5, replace=False)
+            solutions.append(five_point_essential(x1[sample], x2[sample]))
+        Es = np.concatenate(solutions)
+        if len(Es) == 0:
+            continue
+
+        # the (up to 10 per sample) solutions of the batch are scored together
+        counts = score_hypotheses(Es, x1, x2, threshold)
+        best = int(np.argmax(counts))
+        if counts[best] <= best_count:
+            continue
+        E, count = Es[best], int(counts[best])
+        mask = sampson_errors(E, x1, x2)[0] < threshold_sq
+
+        # LO-RANSAC: refit on all the inliers, keep refitting while the inlier set grows
+        for _ in range(lo_iterations):
+            if count < 8:
+                break
+            E_lo = linear_essential(x1[mask], x2[mask])
+            mask_lo = sampson_errors(E_lo, x1, x2)[0] < threshold_sq
+            if mask_lo.sum() <= count:
+                break
+            E, mask, count = E_lo, mask_lo, int(mask_lo.sum())
+
+        best_E, best_mask, best_count = E, mask, count
+        needed = adaptive_iterations(best_count / N, 5, confidence, max_iterations)
+
+    if best_E is None:
+        raise ValueError("No matching was found !")
+    return best_E, best_mask, best_count / N, iterations
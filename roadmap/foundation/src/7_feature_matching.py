@@ -17,8 +17,9 @@ def files_list(directory):
 
 def orb_keypoints(images):
     kp_des_list = []
+    # a single ORB instance is shared by all the images
+    orb = cv2.ORB_create()
     for image in images:
-        orb = cv2.ORB_create()
         # find the keypoints with ORB
         kp = orb.detect(image,None)
         # compute the descriptors with ORB